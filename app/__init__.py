@@ -4,6 +4,7 @@ from logging.handlers import RotatingFileHandler
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
+from app.log_pipeline import setup_logging, parse_mapping
 
 # Determinăm calea către fișierul de log
 log_file_path = os.path.join("logs", "webserver.log")
@@ -19,20 +20,43 @@ webserver = Flask(__name__)
 
 # Configurăm logger-ul pentru a scrie în fișierele .log din folderul "logs"
 LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
-# Folosim nivelul de logging INFO
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
-# 10 MB max per file, keep 5 files
+# 10 MB max per file, keep 5 files; only the server's own records go to the file
 handler = RotatingFileHandler(log_file_path, maxBytes=10*1024*1024, backupCount=5)
 handler.setFormatter(logging.Formatter(LOG_FORMAT))
-
-# Adăugăm handler-ul la logger-ul instanței de Flask
-webserver.logger.addHandler(handler)
-
-# Pornesc ThreadPool-ul si thread-urile
-webserver.tasks_runner = ThreadPool()
-webserver.tasks_runner.start()
+handler.addFilter(logging.Filter(webserver.name))
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+def configure_logging():
+    """
+    Send the records through a queue to a thread writing them to the log file and
+    the console, instead of writing them on the request thread.
+    """
+    # Nivelul implicit este INFO
+    setup_logging(
+        [handler, console_handler],
+        level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+        queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+        sample_rates=parse_mapping(os.environ.get('LOG_SAMPLE_RATES', ''), float),
+        levels=parse_mapping(os.environ.get('LOG_ROUTE_LEVELS', ''),
+                             lambda level: logging.getLevelName(level.upper())))
+
+def start_thread_pool():
+    """
+    Create and start the ThreadPool executing the jobs of this process.
+    """
+    webserver.tasks_runner = ThreadPool(webserver.data_ingestor)
+    webserver.tasks_runner.start()
+
+configure_logging()
 
 webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
 
+# Pornesc ThreadPool-ul si thread-urile; în modul pre-fork (python -m app.prefork)
+# master-ul doar încarcă datele, iar fiecare worker își pornește ThreadPool-ul după fork
+if not os.environ.get('PREFORK_WORKERS'):
+    start_thread_pool()
+
 from app import routes
@@ -0,0 +1,97 @@
+"""
+Precomputed aggregates over the nutrition dataset.
+"""
+import math
+
+VALUE_COLUMN = 'Data_Value'
+STATE_KEYS = ['Question', 'LocationDesc']
+CATEGORY_KEYS = ['Question', 'LocationDesc', 'StratificationCategory1', 'Stratification1']
+
+
+def mean_of(stats):
+    """
+    Return the mean described by a (sum, count) pair, or NaN if it has no values.
+    """
+    value_sum, count = stats
+    if count == 0:
+        return math.nan
+    return value_sum / count
+
+
+class AggregateIndex:
+    """
+    Running sums and counts of Data_Value per question, per (question, state) and
+    per (question, state, StratificationCategory1, Stratification1).
+
+    Every entry is a (sum, count) tuple; NaN values are skipped, exactly like
+    pandas' mean(). Entries are replaced rather than mutated so readers always
+    see a consistent pair, and the mappings of a question are updated on a copy
+    that is then swapped in, so a task iterating them while rows are appended
+    never sees them change size. Updates must not run concurrently.
+    """
+    def __init__(self):
+        # question -> (sum, count)
+        self.questions = {}
+        # question -> {state: (sum, count)}
+        self.states = {}
+        # question -> {state: {(category, segment): (sum, count)}}
+        self.categories = {}
+
+    def update(self, data_frame):
+        """
+        Fold the rows of a DataFrame into the index.
+
+        Each level is grouped on its own keys, so rows with a missing
+        stratification still count towards the question and state totals.
+
+        Args:
+            data_frame (pd.DataFrame): Rows with at least the columns used as keys
+                and the Data_Value column.
+        """
+        grouped = data_frame.groupby('Question', observed=True)[VALUE_COLUMN].agg(['sum', 'count'])
+        for question, value_sum, count in grouped.itertuples():
+            _merge(self.questions, question, value_sum, count)
+
+        grouped = data_frame.groupby(STATE_KEYS, observed=True)[VALUE_COLUMN].agg(['sum', 'count'])
+        updated = {}
+        for (question, state), value_sum, count in grouped.itertuples():
+            if question not in updated:
+                updated[question] = dict(self.states.get(question, {}))
+            _merge(updated[question], state, value_sum, count)
+        self.states.update(updated)
+
+        grouped = data_frame.groupby(CATEGORY_KEYS, observed=True)[VALUE_COLUMN] \
+            .agg(['sum', 'count'])
+        updated = {}
+        copied = set()
+        for (question, state, category, segment), value_sum, count in grouped.itertuples():
+            if question not in updated:
+                updated[question] = dict(self.categories.get(question, {}))
+            if (question, state) not in copied:
+                updated[question][state] = dict(updated[question].get(state, {}))
+                copied.add((question, state))
+            _merge(updated[question][state], (category, segment), value_sum, count)
+        self.categories.update(updated)
+
+    def question_stats(self, question):
+        """
+        Return the (sum, count) pair of a question.
+        """
+        return self.questions.get(question, (0.0, 0))
+
+    def state_stats(self, question):
+        """
+        Return a {state: (sum, count)} mapping for a question.
+        """
+        return self.states.get(question, {})
+
+    def category_stats(self, question):
+        """
+        Return a {state: {(category, segment): (sum, count)}} mapping for a question.
+        """
+        return self.categories.get(question, {})
+
+
+def _merge(target, key, value_sum, count):
+    old_sum, old_count = target.get(key, (0.0, 0))
+    target[key] = (old_sum + float(value_sum), old_count + int(count))
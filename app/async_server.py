@@ -0,0 +1,376 @@
+"""
+Asyncio ingress: serves the Flask routes while holding connections on an event loop.
+
+    python -m app.async_server --host 0.0.0.0 --port 5000
+"""
+import io
+import os
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import resource
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, unquote
+from app import webserver
+from app.routes import LONG_POLL_MAX_WAIT, EVENTS_MAX_WAIT, format_job_event
+from app.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Largest request head accepted, in bytes
+MAX_HEAD_BYTES = 64 * 1024
+
+
+class BadRequest(Exception):
+    """
+    Raised for a request that can't be parsed; the connection is closed after the
+    400 answer.
+    """
+
+
+class AsyncIngress:
+    """
+    An HTTP/1.1 server on asyncio in front of the Flask application.
+
+    Connections, keep-alive included, live on the event loop and cost no thread
+    while idle. Requests are handed to the WSGI application on a small thread
+    pool, so every route answers exactly as under `flask run`. The two waiting
+    routes never block one of those threads: a long-poll of get_results awaits
+    the job's completion on the loop and only then asks the application for the
+    result, and /api/events is streamed from the loop. Job completion resolves
+    futures through JobStore.subscribe() instead of being polled.
+    """
+    def __init__(self, application, job_store, num_threads=32, idle_timeout=75):
+        """
+        Initialize the AsyncIngress instance.
+
+        Args:
+            application: The WSGI application.
+            job_store (JobStore): The store whose jobs the waiting routes await.
+            num_threads (int): Threads running the WSGI application.
+            idle_timeout (float): Seconds a keep-alive connection may sit idle.
+        """
+        self.application = application
+        self.job_store = job_store
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=num_threads,
+                                           thread_name_prefix="AsyncIngress")
+        self.connections = 0
+
+    async def serve(self, host, port):
+        """
+        Accept connections until cancelled.
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                                            limit=MAX_HEAD_BYTES, backlog=4096)
+        logger.info("Async ingress listening on %s:%d", host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answer the requests of one connection until it is closed or idles out.
+        """
+        self.connections += 1
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader, writer),
+                                                     self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except (BadRequest, asyncio.LimitOverrunError, ValueError) as error:
+                    await write_response(writer, "400 BAD REQUEST",
+                                         [('Content-Type', 'text/plain')],
+                                         str(error).encode(), keep_alive=False)
+                    break
+
+                request['peer'] = peer
+                if not await self.dispatch(request, writer):
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        """
+        Answer one request.
+
+        Returns:
+            bool: Whether the connection stays open for the next request.
+        """
+        keep_alive = request['keep_alive']
+        path, query = request['path'], request['query']
+
+        if request['method'] == 'GET' and path == '/api/events':
+            await self.stream_events(query, writer, keep_alive)
+            return keep_alive
+
+        if request['method'] == 'GET' and path.startswith('/api/get_results/'):
+            wait = _float_arg(query, 'wait')
+            if wait > 0:
+                job_id = path[len('/api/get_results/'):]
+                if job_id.isdigit():
+                    await self.wait_for_job(int(job_id), min(wait, LONG_POLL_MAX_WAIT))
+                # The job is done or the wait is over: the route answers without waiting
+                request['query'] = [(name, value) for name, value in query if name != 'wait']
+
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.call_application, request)
+        await write_response(writer, status, headers, body, keep_alive,
+                             head=request['method'] == 'HEAD')
+        return keep_alive
+
+    def call_application(self, request):
+        """
+        Run the WSGI application on a request, on one of the executor's threads.
+
+        Returns:
+            tuple: (status, headers, body).
+        """
+        headers = request['headers']
+        environ = {
+            'REQUEST_METHOD': request['method'],
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(request['path'], encoding='latin-1'),
+            'QUERY_STRING': urlencode(request['query']),
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '0',
+            'SERVER_PROTOCOL': request['version'],
+            'REMOTE_ADDR': str(request['peer'][0]),
+            'REMOTE_PORT': str(request['peer'][1]),
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(request['body'])),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request['body']),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = response_headers
+
+        chunks = self.application(environ, start_response)
+        try:
+            body = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return response['status'], response['headers'], body
+
+    async def wait_for_job(self, job_id, timeout):
+        """
+        Wait until a job is done or the timeout expires, without holding a thread.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def on_done(_job_id, _job):
+            # Called by the thread finishing the job
+            loop.call_soon_threadsafe(_resolve, done, None)
+
+        if not self.job_store.subscribe(job_id, on_done):
+            return
+        try:
+            await asyncio.wait({done}, timeout=timeout)
+        finally:
+            self.job_store.unsubscribe(job_id, on_done)
+
+    async def stream_events(self, query, writer, keep_alive):
+        """
+        Stream server-sent events as the jobs in 'job_ids' finish, like the
+        /api/events route does, from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        job_ids = list(dict.fromkeys(int(job_id) for job_id in
+                                     dict(query).get('job_ids', '').split(',')
+                                     if job_id.isdigit()))
+        timeout = min(_float_arg(query, 'timeout', EVENTS_MAX_WAIT), EVENTS_MAX_WAIT)
+        completions = asyncio.Queue()
+
+        def on_done(job_id, job):
+            loop.call_soon_threadsafe(completions.put_nowait, (job_id, job))
+
+        for job_id in job_ids:
+            if not self.job_store.subscribe(job_id, on_done):
+                completions.put_nowait((job_id, None))
+
+        head = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream; charset=utf-8",
+                "Cache-Control: no-cache", "Transfer-Encoding: chunked",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+        METRICS.inc("webserver_requests_total", (("endpoint", "/api/events"),
+                                                 ("method", "GET"), ("status", "200")))
+        try:
+            deadline = loop.time() + timeout
+            remaining = len(job_ids)
+            while remaining:
+                left = deadline - loop.time()
+                if left <= 0:
+                    break
+                try:
+                    job_id, job = await asyncio.wait_for(completions.get(), min(left, 15))
+                except asyncio.TimeoutError:
+                    # Comentariile SSE țin conexiunea deschisă prin proxy-uri
+                    await _write_chunk(writer, b": keep-alive\n\n")
+                    continue
+                remaining -= 1
+                # Expired jobs are read back from the result log, off the loop
+                event = await loop.run_in_executor(self.executor, format_job_event, job_id, job)
+                await _write_chunk(writer, event.encode())
+            await _write_chunk(writer, b"")
+        finally:
+            for job_id in job_ids:
+                self.job_store.unsubscribe(job_id, on_done)
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _float_arg(query, name, default=0.0):
+    # Like Flask's request.args.get(name, default, type=float)
+    try:
+        return float(dict(query)[name])
+    except (KeyError, ValueError):
+        return default
+
+
+async def read_request(reader, writer):
+    """
+    Read one request from a connection. A client that waits for a 100 Continue
+    before sending the body gets it once the head is read.
+
+    Returns:
+        dict: The method, path, query pairs, version, lower-cased headers, body and
+            whether the connection is kept alive afterwards.
+
+    Raises:
+        asyncio.IncompleteReadError: The client closed the connection.
+        BadRequest: The request is malformed or uses an unsupported feature.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError as error:
+        raise BadRequest("Malformed request line") from error
+
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise BadRequest("Malformed header")
+            headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise BadRequest("Chunked request bodies are not supported")
+    length = int(headers.get('content-length', 0))
+    if length and version != 'HTTP/1.0' and \
+       headers.get('expect', '').lower() == '100-continue':
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await writer.drain()
+    body = await reader.readexactly(length)
+
+    path, _, query = target.partition("?")
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        keep_alive = connection == 'keep-alive'
+    else:
+        keep_alive = connection != 'close'
+
+    return {
+        'method': method,
+        'path': path,
+        'query': parse_qsl(query, keep_blank_values=True),
+        'version': version,
+        'headers': headers,
+        'body': body,
+        'keep_alive': keep_alive,
+    }
+
+
+async def write_response(writer, status, headers, body, keep_alive, head=False):
+    """
+    Write a complete response and wait for the connection to take it. The answer
+    to a HEAD request has the Content-Length the application set for the GET,
+    but no body.
+    """
+    length = len(body)
+    if head:
+        length = next((value for name, value in headers if name.lower() == 'content-length'),
+                      length)
+        body = b''
+
+    lines = [f"HTTP/1.1 {status}"]
+    lines.extend(f"{name}: {value}" for name, value in headers
+                 if name.lower() not in ('content-length', 'connection'))
+    lines.append(f"Content-Length: {length}")
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+
+
+async def _write_chunk(writer, data):
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+    await writer.drain()
+
+
+def raise_file_limit():
+    """
+    Raise the soft limit of open files to the hard one, so that tens of thousands
+    of connections fit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        logger.info("Raised the open file limit from %s to %s", soft, hard)
+
+
+def main():
+    """
+    Serve the application with the async ingress until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve the webserver on asyncio.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    raise_file_limit()
+    ingress = AsyncIngress(webserver, webserver.tasks_runner.job_store,
+                           num_threads=int(os.environ.get('ASYNC_INGRESS_THREADS', 32)),
+                           idle_timeout=float(os.environ.get('ASYNC_IDLE_TIMEOUT', 75)))
+
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(ingress.serve(args.host, args.port))
+    loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        loop.run_until_complete(serving)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        ingress.executor.shutdown(wait=False)
+        webserver.tasks_runner.stop()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
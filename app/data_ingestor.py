@@ -1,18 +1,106 @@
+import io
+import os
+import logging
+from threading import Lock
 import pandas as pd
+from pandas.api.types import union_categoricals
+from app.aggregate_index import AggregateIndex, VALUE_COLUMN
+from app.distribution_index import DistributionIndex, SketchIndex
+from app.time_index import TimeIndex, YEAR_COLUMN
+from app.snapshot import source_metadata, read_snapshot_header, read_snapshot, write_snapshot, \
+    READ_ERRORS
+
+# Text columns read by the analytic tasks, stored as categoricals (integer codes
+# plus a lookup table of distinct values)
+CATEGORY_COLUMNS = ['Question', 'LocationDesc', 'StratificationCategory1', 'Stratification1']
+
+# Every column kept from the CSV
+INGESTED_COLUMNS = CATEGORY_COLUMNS + [VALUE_COLUMN, YEAR_COLUMN]
+
+logger = logging.getLogger(__name__)
 
 class DataIngestor:
     """
     Class for ingesting data from a CSV file.
     """
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, value_dtype=None, snapshot_path=None, memory_budget=None):
         """
         Initialize the DataIngestor instance.
 
+        Only the columns the tasks need are kept: the text columns as categoricals,
+        Data_Value as a float array and YearStart as an int16 array. After the CSV
+        is parsed the columns are written to a binary snapshot, which later starts
+        memory-map instead of parsing again as long as the CSV's hash and columns
+        still match.
+
+        With a memory budget the CSV is instead streamed in chunks sized to fit
+        it, and only the indexes are kept: `data` is None and no snapshot is
+        involved. This serves datasets larger than memory, since the indexes only
+        grow with the number of questions, states, segments and years. The sorted
+        values of the distribution index would grow with the rows, so quantiles
+        are then estimated from t-digest sketches of at most about
+        QUANTILE_SKETCH_COMPRESSION (100 by default) centroids each instead.
+
         Args:
             csv_path (str): The path to the CSV file.
+            value_dtype (str): 'float32' or 'float64' for Data_Value. Defaults to the
+                DATA_VALUE_DTYPE environment variable, or 'float64'.
+            snapshot_path (str): Where to keep the snapshot. Defaults to the
+                DATA_SNAPSHOT_PATH environment variable, or the CSV path with a
+                '.snapshot' suffix. An empty string disables snapshots.
+            memory_budget (int): Bytes the parsing may use at once; enables the
+                streaming mode. Defaults to the DATA_MEMORY_BUDGET environment
+                variable; unset or 0 loads the whole CSV.
+        """
+        if value_dtype is None:
+            value_dtype = os.environ.get('DATA_VALUE_DTYPE', 'float64')
+        if snapshot_path is None:
+            snapshot_path = os.environ.get('DATA_SNAPSHOT_PATH', f"{csv_path}.snapshot")
+        if memory_budget is None:
+            memory_budget = int(os.environ.get('DATA_MEMORY_BUDGET') or 0)
+
+        if memory_budget:
+            self._initialize(None)
+            # Rows are buffered for the sketches in about an eighth of the budget,
+            # counting the sorting of a flush
+            self.distributions = SketchIndex(
+                int(os.environ.get('QUANTILE_SKETCH_COMPRESSION', 100)),
+                max(memory_budget // 128, 1024))
+            rows = self._stream_csv(csv_path, value_dtype, memory_budget)
+            logger.info("Aggregated %d rows from %s in chunks of at most %d bytes",
+                        rows, csv_path, memory_budget)
+            return
+
+        self._initialize(self._load(csv_path, value_dtype, snapshot_path))
+
+        logger.info("Loaded %d rows from %s, %.1f KiB resident", len(self.data), csv_path,
+                    self.memory_footprint() / 1024)
+
+    @classmethod
+    def from_frame(cls, data_frame):
+        """
+        Build a DataIngestor over columns that were already ingested elsewhere.
+
+        Args:
+            data_frame (pd.DataFrame): The columns, as kept by DataIngestor.data.
+        """
+        data_ingestor = cls.__new__(cls)
+        data_ingestor._initialize(data_frame)
+        return data_ingestor
+
+    def _initialize(self, data_frame):
+        """
+        Set up the question lists and the indexes over the ingested columns, if
+        any are kept.
         """
-        # TODO: Read csv from csv_path
-        self.data = pd.read_csv(csv_path)
+        self.data = data_frame
+        # Bumped whenever the data changes, so results cached for it are dropped
+        self.version = 0
+        # Tells this load of the dataset apart from those of other processes and
+        # restarts, whose versions also start at 0
+        self.identity = os.urandom(8).hex()
+        # Serializes the appends of new rows
+        self.append_lock = Lock()
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -28,3 +116,194 @@ class DataIngestor:
             'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
             'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
         ]
+
+        # Precompute the sums and counts the analytic tasks are answered from, per
+        # year for ranges of years, and the sorted values the quantiles and
+        # standard deviations are read from
+        self.index = AggregateIndex()
+        self.time_index = TimeIndex()
+        self.distributions = DistributionIndex()
+        if self.data is not None:
+            self._index_rows(self.data)
+
+    def _index_rows(self, rows):
+        """
+        Fold rows into every index.
+        """
+        self.index.update(rows)
+        self.time_index.update(rows)
+        self.distributions.update(rows)
+
+    def append(self, rows):
+        """
+        Add rows to the dataset and fold them into the indexes.
+
+        The indexes are updated before the version is bumped, so a result cached under
+        the new version is never computed from the old aggregates.
+
+        Args:
+            rows (pd.DataFrame): Validated rows, as returned by read_rows().
+
+        Returns:
+            int: The new dataset version.
+        """
+        with self.append_lock:
+            if self.data is not None:
+                self._append_columns(rows)
+
+            self._index_rows(rows)
+            self.version += 1
+            logger.info("Appended %d rows, dataset version %d", len(rows), self.version)
+            return self.version
+
+    def _append_columns(self, rows):
+        """
+        Concatenate rows to the kept columns.
+        """
+        rows = rows.astype({column: self.data[column].dtype
+                            for column in (VALUE_COLUMN, YEAR_COLUMN)})
+        columns = {column: union_categoricals([self.data[column], rows[column]],
+                                                  ignore_order=True)
+                   for column in CATEGORY_COLUMNS}
+        for column in (VALUE_COLUMN, YEAR_COLUMN):
+            columns[column] = pd.concat([self.data[column], rows[column]], ignore_index=True)
+        self.data = pd.DataFrame(columns)[self.data.columns]
+
+    @staticmethod
+    def read_rows(payload, data_format):
+        """
+        Parse and validate rows sent for appending.
+
+        Every row needs the columns the tasks read; other columns are ignored.
+        Data_Value may be empty, but must otherwise be a number, YearStart must be
+        a year, and Question and LocationDesc must not be empty.
+
+        Args:
+            payload (bytes): The rows, as CSV with a header line or as one JSON
+                object per line.
+            data_format (str): 'csv' or 'ndjson'.
+
+        Returns:
+            pd.DataFrame: The ingested columns of the rows.
+
+        Raises:
+            ValueError: The payload can't be parsed or a row doesn't fit the schema.
+        """
+        if data_format == 'csv':
+            rows = pd.read_csv(io.BytesIO(payload), dtype=str)
+        elif data_format == 'ndjson':
+            rows = pd.read_json(io.BytesIO(payload), lines=True, dtype=False)
+        else:
+            raise ValueError(f"Unknown data format {data_format!r}")
+
+        missing = [column for column in INGESTED_COLUMNS if column not in rows.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+        rows = rows[INGESTED_COLUMNS]
+        rows = rows.where(rows != '')
+
+        values = pd.to_numeric(rows[VALUE_COLUMN], errors='coerce')
+        invalid = rows.index[values.isna() & rows[VALUE_COLUMN].notna()]
+        if len(invalid):
+            raise ValueError(f"{VALUE_COLUMN} is not a number in rows {invalid[:10].tolist()}")
+        years = pd.to_numeric(rows[YEAR_COLUMN], errors='coerce')
+        invalid = rows.index[~years.between(1, 32767) | (years % 1 != 0)]
+        if len(invalid):
+            raise ValueError(f"{YEAR_COLUMN} is not a year in rows {invalid[:10].tolist()}")
+        for column in ('Question', 'LocationDesc'):
+            invalid = rows.index[rows[column].isna()]
+            if len(invalid):
+                raise ValueError(f"{column} is empty in rows {invalid[:10].tolist()}")
+
+        # Categories are strings, whatever JSON type a value was sent as
+        rows = pd.DataFrame({
+            column: rows[column].where(rows[column].isna(), rows[column].astype(str))
+            .astype('category')
+            for column in CATEGORY_COLUMNS})
+        rows[VALUE_COLUMN] = values.astype('float64')
+        rows[YEAR_COLUMN] = years.astype('int16')
+        return rows
+
+    def is_valid_question(self, question):
+        """
+        Check whether a question is one of the known questions.
+        """
+        return question in self.questions_best_is_min or question in self.questions_best_is_max
+
+    def memory_footprint(self):
+        """
+        Return the number of bytes held by the ingested columns, lookup tables
+        included, or 0 if no rows are kept.
+        """
+        if self.data is None:
+            return 0
+        return int(self.data.memory_usage(deep=True).sum())
+
+    def _load(self, csv_path, value_dtype, snapshot_path):
+        """
+        Memory-map a matching snapshot of the CSV, or parse the CSV and snapshot it.
+        """
+        if not snapshot_path:
+            return self._read_csv(csv_path, value_dtype)
+
+        metadata = source_metadata(csv_path)
+        metadata['value_dtype'] = value_dtype
+
+        # A truncated or corrupt snapshot is stale, and rewritten from the CSV
+        try:
+            header = None
+            if os.path.exists(snapshot_path):
+                header = read_snapshot_header(snapshot_path)
+            if header is not None and \
+               header.get('source_sha256') == metadata['source_sha256'] and \
+               header.get('value_dtype') == value_dtype and \
+               {column['name'] for column in header['columns']} == set(INGESTED_COLUMNS):
+                logger.info("Mapping snapshot %s of %s", snapshot_path, csv_path)
+                return read_snapshot(snapshot_path, header)
+        except READ_ERRORS as error:
+            logger.warning("Ignoring unreadable snapshot %s: %s", snapshot_path, error)
+
+        data = self._read_csv(csv_path, value_dtype)
+        try:
+            write_snapshot(snapshot_path, data, metadata)
+            logger.info("Wrote snapshot %s of %s", snapshot_path, csv_path)
+        except OSError as error:
+            logger.warning("Could not write snapshot %s: %s", snapshot_path, error)
+        return data
+
+    def _stream_csv(self, csv_path, value_dtype, memory_budget):
+        """
+        Fold the CSV into the indexes chunk by chunk.
+
+        The parser's memory grows with the raw text of a chunk, so the length of
+        a line is measured on the start of the file, and chunks hold as many lines
+        as fit in a quarter of the budget; the rest is left to the parsed strings
+        and the groupby of the chunk.
+
+        Returns:
+            int: Number of rows read.
+        """
+        with open(csv_path, 'rb') as file:
+            sample = file.readlines(1024 * 1024)
+        line_bytes = max(sum(len(line) for line in sample) / max(len(sample), 1), 1)
+        chunk_rows = max(int(memory_budget / 4 / line_bytes), 1000)
+
+        rows = 0
+        for chunk in self._read_csv(csv_path, value_dtype, chunksize=chunk_rows):
+            self.index.update(chunk)
+            self.time_index.update(chunk)
+            self.distributions.buffer(chunk)
+            rows += len(chunk)
+        self.distributions.flush()
+        return rows
+
+    @staticmethod
+    def _read_csv(csv_path, value_dtype, **kwargs):
+        """
+        Parse the columns used by the tasks out of the CSV; keyword arguments,
+        such as chunksize, are passed on to pd.read_csv().
+        """
+        dtypes = {column: 'category' for column in CATEGORY_COLUMNS}
+        dtypes[VALUE_COLUMN] = value_dtype
+        dtypes[YEAR_COLUMN] = 'int16'
+        return pd.read_csv(csv_path, usecols=INGESTED_COLUMNS, dtype=dtypes, **kwargs)
@@ -0,0 +1,556 @@
+"""
+Precomputed value distributions over the nutrition dataset.
+"""
+import math
+import numpy as np
+import pandas as pd
+from app.aggregate_index import VALUE_COLUMN
+from app.time_index import YEAR_COLUMN
+
+
+class Distribution:
+    """
+    The sorted Data_Value values of a group, with their mean and sum of squared
+    deviations, so quantiles and the standard deviation are answered without
+    touching the rows again.
+
+    The YearStart of every value is kept alongside it. Filtering a sorted array
+    keeps it sorted, so the distribution of a range of years is a mask away.
+    """
+    __slots__ = ('values', 'years', 'mean', 'm2')
+
+    def __init__(self, values, years, mean, m2):
+        self.values = values
+        self.years = years
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of_sorted(cls, values, years):
+        """
+        Build the distribution of already sorted values and their years.
+        """
+        if len(values) == 0:
+            return cls(values, years, 0.0, 0.0)
+        deviations = values.astype('float64', copy=False) - values.mean(dtype='float64')
+        return cls(values, years, float(values.mean(dtype='float64')),
+                   float(np.square(deviations).sum()))
+
+    def merge(self, other):
+        """
+        Return the distribution of the values of both distributions.
+
+        The sorted arrays are merged in linear time, and the moments are combined
+        with Chan's parallel formula.
+        """
+        count, other_count = len(self.values), len(other.values)
+        if count == 0:
+            return other
+        if other_count == 0:
+            return self
+
+        positions = np.searchsorted(self.values, other.values, side='right')
+        values = np.insert(self.values, positions, other.values)
+        years = np.insert(self.years, positions, other.years)
+        total = count + other_count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other_count / total
+        m2 = self.m2 + other.m2 + delta * delta * count * other_count / total
+        return Distribution(values, years, mean, m2)
+
+    def between(self, year_start=None, year_end=None):
+        """
+        Return the distribution of the values from year_start to year_end, both
+        included; None leaves that end of the range open.
+        """
+        kept = np.ones(len(self.values), dtype=bool)
+        if year_start is not None:
+            kept &= self.years >= year_start
+        if year_end is not None:
+            kept &= self.years <= year_end
+        return Distribution.of_sorted(self.values[kept], self.years[kept])
+
+    def quantile(self, q):
+        """
+        Return the q-th quantile, interpolated linearly like pandas' quantile(),
+        or NaN if there are no values.
+        """
+        if len(self.values) == 0:
+            return math.nan
+        position = q * (len(self.values) - 1)
+        lower = int(math.floor(position))
+        upper = min(lower + 1, len(self.values) - 1)
+        low, high = float(self.values[lower]), float(self.values[upper])
+        return low + (high - low) * (position - lower)
+
+    def stddev(self):
+        """
+        Return the sample standard deviation, like pandas' std(), or NaN for
+        fewer than two values.
+        """
+        if len(self.values) < 2:
+            return math.nan
+        return math.sqrt(max(self.m2, 0.0) / (len(self.values) - 1))
+
+
+EMPTY = Distribution(np.empty(0), np.empty(0, dtype=np.int16), 0.0, 0.0)
+
+
+class DistributionIndex:
+    """
+    The Distribution of Data_Value per question and per (question, state); NaN
+    values are skipped, like pandas does.
+
+    Like AggregateIndex, the mappings of a question are updated on a copy that is
+    swapped in, so readers always see a consistent index, and updates must not
+    run concurrently. The values are kept in the dtype of the column.
+    """
+    def __init__(self):
+        # question -> Distribution
+        self.questions = {}
+        # question -> {state: Distribution}
+        self.states = {}
+
+    def update(self, data_frame):
+        """
+        Fold the rows of a DataFrame into the index.
+
+        The rows are sorted by question and value, then by question, state and
+        value, and every group is a slice of one of those orders.
+
+        Args:
+            data_frame (pd.DataFrame): Rows with at least the Question,
+                LocationDesc, YearStart and Data_Value columns.
+        """
+        values = data_frame[VALUE_COLUMN].to_numpy()
+        years = data_frame[YEAR_COLUMN].to_numpy()
+        questions = pd.Categorical(data_frame['Question'])
+        states = pd.Categorical(data_frame['LocationDesc'])
+
+        # Rows without a value or a question count nowhere, like in a groupby
+        kept = ~np.isnan(values) & (questions.codes >= 0)
+        values, years, question_codes, state_codes = \
+            values[kept], years[kept], questions.codes[kept], states.codes[kept]
+
+        order = np.lexsort((values, question_codes))
+        for start, end in _runs(question_codes[order]):
+            question = questions.categories[question_codes[order[start]]]
+            self.questions[question] = self.question_distribution(question).merge(
+                Distribution.of_sorted(values[order[start:end]], years[order[start:end]]))
+
+        kept = state_codes >= 0
+        values, years, question_codes, state_codes = \
+            values[kept], years[kept], question_codes[kept], state_codes[kept]
+        order = np.lexsort((values, state_codes, question_codes))
+        values, years, question_codes, state_codes = \
+            values[order], years[order], question_codes[order], state_codes[order]
+
+        updated = {}
+        for start, end in _runs(question_codes, state_codes):
+            question = questions.categories[question_codes[start]]
+            state = states.categories[state_codes[start]]
+            if question not in updated:
+                updated[question] = dict(self.states.get(question, {}))
+            updated[question][state] = updated[question].get(state, EMPTY).merge(
+                Distribution.of_sorted(values[start:end], years[start:end]))
+        self.states.update(updated)
+
+    def question_distribution(self, question):
+        """
+        Return the Distribution of a question.
+        """
+        return self.questions.get(question, EMPTY)
+
+    def state_distributions(self, question):
+        """
+        Return a {state: Distribution} mapping for a question.
+        """
+        return self.states.get(question, {})
+
+    def between(self, year_start=None, year_end=None):
+        """
+        Return the distributions of the years from year_start to year_end.
+
+        Returns:
+            DistributionRange: A view with the lookup methods of DistributionIndex.
+        """
+        return DistributionRange(self, year_start, year_end)
+
+
+class DistributionRange:
+    """
+    The distributions of a range of years, looked up like those of a
+    DistributionIndex. Each lookup masks the values of the whole index entry, and
+    states without values in the range are left out.
+    """
+    def __init__(self, index, year_start, year_end):
+        self.index = index
+        self.year_start = year_start
+        self.year_end = year_end
+
+    def question_distribution(self, question):
+        """
+        Return the Distribution of a question in the range.
+        """
+        return self.index.question_distribution(question).between(self.year_start, self.year_end)
+
+    def state_distributions(self, question):
+        """
+        Return a {state: Distribution} mapping for a question in the range.
+        """
+        distributions = self.index.state_distributions(question)
+        distributions = {state: distribution.between(self.year_start, self.year_end)
+                         for state, distribution in distributions.items()}
+        return {state: distribution for state, distribution in distributions.items()
+                if len(distribution.values) > 0}
+
+
+# Points compressed at once by a flush of a SketchIndex
+FLUSH_POINTS = 1 << 16
+
+
+class Sketch:
+    """
+    A merging t-digest of a group's values: weighted centroids sorted by mean,
+    with the exact count, mean, sum of squared deviations, minimum and maximum.
+
+    Quantiles are interpolated between the centroids, so they are exact as long
+    as every centroid holds a single value, and approximate, most precisely in
+    the tails, once the group was compressed. The standard deviation is exact.
+    """
+    __slots__ = ('means', 'weights', 'count', 'mean', 'm2', 'minimum', 'maximum')
+
+    def __init__(self, means, weights, count, mean, m2, minimum, maximum):
+        self.means = means
+        self.weights = weights
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def quantile(self, q):
+        """
+        Return the estimated q-th quantile, or NaN if there are no values.
+
+        Every centroid stands at the middle of the positions of its values, and
+        the minimum and maximum at the ends, so with single-value centroids this
+        is pandas' linear interpolation.
+        """
+        if self.count == 0:
+            return math.nan
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate(([0.5], centers, [self.count - 0.5]))
+        values = np.concatenate(([self.minimum], self.means, [self.maximum]))
+        return float(np.interp(q * (self.count - 1) + 0.5, positions, values))
+
+    def stddev(self):
+        """
+        Return the sample standard deviation, like pandas' std(), or NaN for
+        fewer than two values.
+        """
+        if self.count < 2:
+            return math.nan
+        return math.sqrt(max(self.m2, 0.0) / (self.count - 1))
+
+
+class SketchIndex:
+    """
+    A Sketch of Data_Value per question and per (question, state), for each
+    YearStart, looked up like a DistributionIndex; the sketches of a range of
+    years are merged when read.
+
+    Unlike the sorted values of a DistributionIndex, a sketch never holds more
+    than about `compression` centroids, so the index grows with the number of
+    questions, states and years rather than with the rows. Rows are buffered and
+    folded into every sketch at once, with vectorized operations, when the buffer
+    holds `buffer_rows` rows or on flush().
+
+    The sketches are kept in flat arrays, grouped by sketch and sorted by mean,
+    and swapped in together after a flush built them, so readers always see a
+    consistent index. Updates must not run concurrently.
+    """
+    def __init__(self, compression=100, buffer_rows=65536):
+        self.compression = compression
+        self.buffer_rows = buffer_rows
+        # Numbers of the questions and states, in order of appearance; state 0
+        # stands for the sketch of the question's values over all states
+        self.question_numbers = {}
+        self.state_numbers = {None: 0}
+        # Sketch number of every (question number, state number, year) key, packed
+        # in an integer, and the (question, state, year) of every sketch number
+        self.sketch_ids = {}
+        self.sketch_keys = []
+        # (sketch numbers, values) arrays waiting for the next flush
+        self.pending = []
+        self.pending_rows = 0
+        # (centroid starts, means, weights, count, mean, m2, minimum, maximum,
+        #  {question: {state: (years, sketch numbers)}})
+        self.tables = (np.zeros(1, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0),
+                       np.empty(0), np.empty(0), np.empty(0), np.empty(0), {})
+
+    def update(self, data_frame):
+        """
+        Fold the rows of a DataFrame into the index right away.
+        """
+        self.buffer(data_frame)
+        self.flush()
+
+    def buffer(self, data_frame):
+        """
+        Add the rows of a DataFrame to the buffer, and flush it once it is full.
+
+        Args:
+            data_frame (pd.DataFrame): Rows with at least the Question,
+                LocationDesc, YearStart and Data_Value columns.
+        """
+        values = data_frame[VALUE_COLUMN].to_numpy(dtype='float64')
+        years = data_frame[YEAR_COLUMN].to_numpy().astype(np.int64)
+        questions = pd.Categorical(data_frame['Question'])
+        states = pd.Categorical(data_frame['LocationDesc'])
+
+        # Rows without a value or a question count nowhere, like in a groupby; a
+        # row without a state only counts for its question
+        kept = ~np.isnan(values) & (questions.codes >= 0)
+        values, years = values[kept], years[kept]
+        question_codes = questions.codes[kept].astype(np.int64)
+        state_codes = states.codes[kept].astype(np.int64)
+        with_state = state_codes >= 0
+
+        # Every row goes to its question's sketch and its state's
+        question_numbers = _numbers(self.question_numbers, questions.categories)[question_codes]
+        state_numbers = _numbers(self.state_numbers, states.categories)[state_codes[with_state]]
+        keys = np.concatenate((question_numbers << 32 | years,
+                               (question_numbers[with_state] << 16 | state_numbers) << 16
+                               | years[with_state]))
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        sketch_ids = np.array([self._sketch_id(key) for key in unique_keys.tolist()],
+                              dtype=np.int64)
+
+        self.pending.append((sketch_ids[inverse], np.concatenate((values, values[with_state]))))
+        self.pending_rows += len(values)
+        if self.pending_rows >= self.buffer_rows:
+            self.flush()
+
+    def _sketch_id(self, key):
+        """
+        Return the number of the sketch of a packed key, numbering it if it's new.
+        """
+        sketch_id = self.sketch_ids.get(key)
+        if sketch_id is None:
+            sketch_id = self.sketch_ids[key] = len(self.sketch_keys)
+            numbers, year = divmod(key, 1 << 16)
+            question_number, state_number = divmod(numbers, 1 << 16)
+            self.sketch_keys.append((list(self.question_numbers)[question_number],
+                                     list(self.state_numbers)[state_number], year))
+        return sketch_id
+
+    def flush(self):
+        """
+        Fold the buffered rows into the sketches.
+        """
+        if not self.pending:
+            return
+        ids = np.concatenate([ids for ids, _ in self.pending])
+        values = np.concatenate([values for _, values in self.pending])
+        self.pending, self.pending_rows = [], 0
+
+        starts, means, weights, count, mean, m2, minimum, maximum, _ = self.tables
+        num_sketches = len(self.sketch_keys)
+        grown = num_sketches - len(count)
+        count = np.concatenate((count, np.zeros(grown)))
+        mean = np.concatenate((mean, np.zeros(grown)))
+        m2 = np.concatenate((m2, np.zeros(grown)))
+        minimum = np.concatenate((minimum, np.full(grown, np.inf)))
+        maximum = np.concatenate((maximum, np.full(grown, -np.inf)))
+
+        # Exact moments, combined with those of the sketch by Chan's formula
+        added = np.bincount(ids, minlength=num_sketches).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            added_mean = np.bincount(ids, values, num_sketches) / added
+            added_m2 = np.bincount(ids, np.square(values - added_mean[ids]), num_sketches)
+            total = count + added
+            delta = np.where(added > 0, added_mean - mean, 0.0)
+            m2 = m2 + added_m2 + np.nan_to_num(delta * delta * count * added / total)
+            mean = mean + np.nan_to_num(delta * added / total)
+        count = total
+        np.fmin.at(minimum, ids, values)
+        np.fmax.at(maximum, ids, values)
+
+        # The sketches are compressed a slice at a time, so the temporary arrays
+        # stay small whatever the number of centroids
+        order = np.argsort(ids, kind='stable')
+        ids, values = ids[order], values[order]
+        starts = np.concatenate((starts, np.full(grown, starts[-1])))
+        added_starts = np.searchsorted(ids, np.arange(num_sketches + 1))
+        point_starts = starts + added_starts
+        pieces = []
+        first = 0
+        while first < num_sketches:
+            last = int(np.searchsorted(point_starts, point_starts[first] + FLUSH_POINTS, 'right'))
+            last = min(max(last - 1, first + 1), num_sketches)
+            pieces.append(_compress(
+                np.concatenate((np.repeat(np.arange(last - first), np.diff(starts[first:last + 1])),
+                                ids[added_starts[first]:added_starts[last]] - first)),
+                np.concatenate((means[starts[first]:starts[last]],
+                                values[added_starts[first]:added_starts[last]])),
+                np.concatenate((weights[starts[first]:starts[last]],
+                                np.ones(added_starts[last] - added_starts[first]))),
+                count[first:last], self.compression))
+            first = last
+
+        starts = np.concatenate(([0], np.cumsum(np.concatenate([piece[0] for piece in pieces]))))
+        means = np.concatenate([piece[1] for piece in pieces])
+        weights = np.concatenate([piece[2] for piece in pieces])
+
+        lookup = {}
+        for sketch_id, (question, state, year) in enumerate(self.sketch_keys):
+            lookup.setdefault(question, {}).setdefault(state, []).append((year, sketch_id))
+        lookup = {question: {state: tuple(np.array(column) for column in zip(*entries))
+                             for state, entries in by_state.items()}
+                  for question, by_state in lookup.items()}
+
+        self.tables = (starts, means, weights, count, mean, m2, minimum, maximum, lookup)
+
+    def question_distribution(self, question):
+        """
+        Return the Sketch of a question.
+        """
+        return self.between().question_distribution(question)
+
+    def state_distributions(self, question):
+        """
+        Return a {state: Sketch} mapping for a question.
+        """
+        return self.between().state_distributions(question)
+
+    def between(self, year_start=None, year_end=None):
+        """
+        Return the sketches of the years from year_start to year_end, both
+        included; None leaves that end of the range open.
+
+        Returns:
+            SketchRange: A view with the lookup methods of DistributionIndex.
+        """
+        return SketchRange(self.tables, year_start, year_end)
+
+
+class SketchRange:
+    """
+    The sketches of a range of years, looked up like those of a
+    DistributionIndex. Each lookup merges the sketches of the years in the range,
+    and states without values in the range are left out.
+    """
+    def __init__(self, tables, year_start, year_end):
+        self.tables = tables
+        self.year_start = year_start
+        self.year_end = year_end
+
+    def _merged(self, entry):
+        starts, means, weights, count, mean, m2, minimum, maximum, _ = self.tables
+        years, sketch_ids = entry
+        kept = np.ones(len(years), dtype=bool)
+        if self.year_start is not None:
+            kept &= years >= self.year_start
+        if self.year_end is not None:
+            kept &= years <= self.year_end
+        sketch_ids = sketch_ids[kept]
+        counts = count[sketch_ids]
+        total = counts.sum()
+        if total == 0:
+            return EMPTY_SKETCH
+
+        # Chan's formula over all the yearly sketches at once
+        merged_mean = float((counts * mean[sketch_ids]).sum() / total)
+        merged_m2 = float(m2[sketch_ids].sum() +
+                          (counts * np.square(mean[sketch_ids] - merged_mean)).sum())
+        slices = [slice(starts[sketch_id], starts[sketch_id + 1]) for sketch_id in sketch_ids]
+        merged_means = np.concatenate([means[part] for part in slices])
+        merged_weights = np.concatenate([weights[part] for part in slices])
+        order = np.argsort(merged_means, kind='stable')
+        return Sketch(merged_means[order], merged_weights[order], int(round(total)),
+                      merged_mean, merged_m2,
+                      float(minimum[sketch_ids].min()), float(maximum[sketch_ids].max()))
+
+    def question_distribution(self, question):
+        """
+        Return the Sketch of a question in the range.
+        """
+        entry = self.tables[8].get(question, {}).get(None)
+        return EMPTY_SKETCH if entry is None else self._merged(entry)
+
+    def state_distributions(self, question):
+        """
+        Return a {state: Sketch} mapping for a question in the range.
+        """
+        sketches = {state: self._merged(entry)
+                    for state, entry in self.tables[8].get(question, {}).items()
+                    if state is not None}
+        return {state: sketch for state, sketch in sketches.items() if sketch.count > 0}
+
+
+EMPTY_SKETCH = Sketch(np.empty(0), np.empty(0), 0, 0.0, 0.0, math.nan, math.nan)
+
+
+def _compress(ids, means, weights, counts, compression):
+    """
+    Merge the centroids and values of consecutive sketches into their new
+    centroids.
+
+    Sketches with up to `compression` points keep one centroid per point; the
+    others merge the neighbours falling in the same unit of the k1 scale function,
+    which keeps the centroids small in the tails.
+
+    Args:
+        ids (np.ndarray): The sketch of every point, numbered from 0.
+        means (np.ndarray): The mean of every point.
+        weights (np.ndarray): The number of values of every point.
+        counts (np.ndarray): The number of values of every sketch.
+        compression (int): The t-digest compression.
+
+    Returns:
+        tuple: The number of centroids of every sketch, and the means and weights
+            of the centroids, in order.
+    """
+    # The means are scaled below 1 and added to the sketch numbers, so one stable
+    # sort, which takes advantage of the runs already in order, sorts the points
+    # by sketch and then by mean
+    low, high = np.min(means), np.max(means)
+    order = np.argsort(ids + (means - low) / max(high - low, np.finfo(float).tiny) * 0.5,
+                       kind='stable')
+    ids, means, weights = ids[order], means[order], weights[order]
+    starts = np.searchsorted(ids, np.arange(len(counts) + 1))
+
+    cumulative = np.cumsum(weights)
+    before = np.concatenate(([0.0], cumulative))[starts[:-1]][ids]
+    ranks = (cumulative - weights / 2 - before) / counts[ids]
+    buckets = np.floor(compression / (2 * np.pi) *
+                       np.arcsin(np.clip(2 * ranks - 1, -1, 1))).astype(np.int64)
+    few = np.diff(starts)[ids] <= compression
+    buckets[few] = np.arange(len(ids))[few]
+    bounds = np.flatnonzero(np.concatenate((
+        [True], (ids[1:] != ids[:-1]) | (buckets[1:] != buckets[:-1]))))
+
+    merged_weights = np.add.reduceat(weights, bounds)
+    return (np.bincount(ids[bounds], minlength=len(counts)),
+            np.add.reduceat(means * weights, bounds) / merged_weights, merged_weights)
+
+
+def _numbers(numbers, names):
+    """
+    Return the numbers of names as an array, numbering the new ones in order.
+    """
+    return np.array([numbers.setdefault(name, len(numbers)) for name in names], dtype=np.int64)
+
+
+def _runs(*keys):
+    """
+    Yield the (start, end) slices of the runs of equal keys in sorted key arrays.
+    """
+    if len(keys[0]) == 0:
+        return
+    changes = np.zeros(len(keys[0]) - 1, dtype=bool)
+    for key in keys:
+        changes |= key[1:] != key[:-1]
+    bounds = np.concatenate(([0], np.flatnonzero(changes) + 1, [len(keys[0])]))
+    yield from zip(bounds[:-1].tolist(), bounds[1:].tolist())
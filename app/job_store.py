@@ -0,0 +1,204 @@
+"""
+Thread-safe registry of the jobs submitted to the thread pool.
+"""
+import time
+from collections import deque
+from threading import Lock, Event
+
+
+class JobStore:
+    """
+    Keeps the status and result of every job, spread over several shards so the
+    worker threads and the request handlers rarely wait on the same lock.
+
+    Finished jobs are evicted once they are older than a TTL, or oldest first when
+    the store holds more than a maximum number of jobs. Ids are never reused, so an
+    id that was handed out but is no longer stored is known to have expired.
+    """
+    # The jobs are only known to this process
+    shared = False
+
+    def __init__(self, num_shards=16, ttl=None, max_entries=None):
+        """
+        Initialize the JobStore instance.
+
+        Args:
+            num_shards (int): Number of independently locked shards.
+            ttl (float): Seconds a finished job is kept, None to keep it until
+                max_entries forces it out.
+            max_entries (int): Maximum number of stored jobs, None for no limit.
+                Jobs that have not finished yet are never evicted.
+        """
+        # Each shard holds its jobs, its lock and the callbacks waiting on its jobs
+        self.shards = [({}, Lock(), {}) for _ in range(num_shards)]
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.id_lock = Lock()
+        self.last_id = 0
+
+        # Finished jobs in the order they finished, as (finish time, job id)
+        self.eviction_lock = Lock()
+        self.finished = deque()
+        self.size = 0
+        self.evictions = 0
+
+    def _shard(self, job_id):
+        return self.shards[job_id % len(self.shards)]
+
+    def create(self):
+        """
+        Allocate a new job id and register the job as running.
+        """
+        with self.id_lock:
+            self.last_id += 1
+            job_id = self.last_id
+
+        jobs, lock, _ = self._shard(job_id)
+        with lock:
+            jobs[job_id] = {"status": "running", "result": None}
+        with self.eviction_lock:
+            self.size += 1
+            self._evict()
+        return job_id
+
+    def start(self, job_id, queue_wait):
+        """
+        Record how long a job waited in the queue before a thread picked it up.
+        """
+        jobs, lock, _ = self._shard(job_id)
+        with lock:
+            job = jobs.get(job_id)
+            if job is not None:
+                jobs[job_id] = dict(job, queue_wait=queue_wait)
+
+    def discard(self, job_id):
+        """
+        Forget a job that was refused before it could be queued.
+        """
+        jobs, lock, _ = self._shard(job_id)
+        with lock:
+            removed = jobs.pop(job_id, None) is not None
+        if removed:
+            with self.eviction_lock:
+                self.size -= 1
+
+    def finish(self, job_id, result, etag=None):
+        """
+        Record the result of a job, and the ETag it is served with, if any, then
+        notify whoever waits on it and evict the jobs that are due.
+        """
+        jobs, lock, listeners = self._shard(job_id)
+        with lock:
+            job = {"status": "done", "result": result,
+                   "queue_wait": jobs.get(job_id, {}).get("queue_wait"), "etag": etag}
+            jobs[job_id] = job
+            callbacks = listeners.pop(job_id, [])
+        for callback in callbacks:
+            callback(job_id, job)
+
+        with self.eviction_lock:
+            self.finished.append((time.monotonic(), job_id))
+            self._evict()
+
+    def get(self, job_id):
+        """
+        Return the status and result of a job, or None if it isn't stored.
+        """
+        jobs, lock, _ = self._shard(job_id)
+        with lock:
+            return jobs.get(job_id)
+
+    def subscribe(self, job_id, callback):
+        """
+        Call callback(job_id, job) once the job is done, right away if it already is.
+        The callback runs on the thread that finishes the job, so it must be quick.
+
+        Returns:
+            bool: False if the job isn't stored, in which case the callback is
+                never called.
+        """
+        jobs, lock, listeners = self._shard(job_id)
+        with lock:
+            job = jobs.get(job_id)
+            if job is None:
+                return False
+            if job["status"] != "done":
+                listeners.setdefault(job_id, []).append(callback)
+                return True
+        callback(job_id, job)
+        return True
+
+    def unsubscribe(self, job_id, callback):
+        """
+        Stop waiting on a job with a callback passed to subscribe().
+        """
+        _, lock, listeners = self._shard(job_id)
+        with lock:
+            callbacks = listeners.get(job_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                listeners.pop(job_id, None)
+
+    def wait(self, job_id, timeout):
+        """
+        Block until a job is done or the timeout expires.
+
+        Returns:
+            dict: The job as get() would return it afterwards.
+        """
+        done = Event()
+
+        def on_done(_job_id, _job):
+            done.set()
+
+        if self.subscribe(job_id, on_done):
+            done.wait(timeout)
+            self.unsubscribe(job_id, on_done)
+        return self.get(job_id)
+
+    def is_expired(self, job_id):
+        """
+        Check whether a job id was handed out but its job has since been evicted.
+        """
+        return 0 < job_id <= self.last_id and self.get(job_id) is None
+
+    def items(self):
+        """
+        Return a list of (job id, job) pairs of the stored jobs, ordered by id.
+        """
+        items = []
+        for jobs, lock, _ in self.shards:
+            with lock:
+                items.extend(jobs.items())
+        return sorted(items)
+
+    def statuses(self):
+        """
+        Return a list of (job id, status) pairs of the stored jobs, ordered by id.
+        """
+        statuses = []
+        for jobs, lock, _ in self.shards:
+            with lock:
+                statuses.extend((job_id, job["status"]) for job_id, job in jobs.items())
+        return sorted(statuses)
+
+    def __len__(self):
+        return self.size
+
+    def _evict(self):
+        deadline = None if self.ttl is None else time.monotonic() - self.ttl
+        while self.finished:
+            finish_time, job_id = self.finished[0]
+            too_old = deadline is not None and finish_time < deadline
+            too_many = self.max_entries is not None and self.size > self.max_entries
+            if not too_old and not too_many:
+                break
+
+            self.finished.popleft()
+            jobs, lock, _ = self._shard(job_id)
+            with lock:
+                del jobs[job_id]
+            self.size -= 1
+            self.evictions += 1
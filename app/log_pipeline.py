@@ -0,0 +1,163 @@
+"""
+Logging through a bounded queue, written out by a background listener.
+"""
+import os
+import atexit
+import random
+import reprlib
+import logging
+from queue import Queue, Full
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+from app.metrics import METRICS
+
+# Longest text a logged payload or result is cut to
+LOG_MAX_CHARS = int(os.environ.get('LOG_MAX_CHARS', 1000))
+
+# Bounded repr of the payloads and results passed to the loggers
+_REPR = reprlib.Repr()
+_REPR.maxlevel = 3
+_REPR.maxdict = 20
+_REPR.maxlist = 20
+_REPR.maxstring = 200
+_REPR.maxother = 200
+
+
+class LazyRepr:
+    """
+    A log argument formatted only if and when the record is written, and then
+    cut to a bounded length, so logging a large result costs nothing on the
+    request thread and little on the listener.
+    """
+    __slots__ = ('value', 'max_chars')
+
+    def __init__(self, value, max_chars=LOG_MAX_CHARS):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self):
+        text = _REPR.repr(self.value)
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars] + '...'
+        return text
+
+
+class RouteFilter(logging.Filter):
+    """
+    Drops records logged while serving a request below the route's level, and
+    keeps only a sample of the rest below WARNING.
+    """
+    def __init__(self, sample_rates=None, levels=None):
+        """
+        Initialize the RouteFilter instance.
+
+        Args:
+            sample_rates (dict): Route rule, e.g. '/api/get_results/<job_id>', to the
+                fraction of its records kept.
+            levels (dict): Route rule to the lowest level logged for it.
+        """
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.levels = levels or {}
+
+    def filter(self, record):
+        if not has_request_context() or request.url_rule is None:
+            return True
+        route = request.url_rule.rule
+        if record.levelno < self.levels.get(route, logging.NOTSET):
+            return False
+        rate = self.sample_rates.get(route, 1.0)
+        if record.levelno < logging.WARNING and rate < 1.0 and random.random() >= rate:
+            METRICS.inc("webserver_log_records_sampled_out_total", (("endpoint", route),))
+            return False
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks: records that find the queue full are
+    dropped and counted.
+
+    Records are queued as they are, with their arguments, rather than formatted
+    first, so the formatting happens on the listener's thread. Arguments must
+    therefore not be mutated after they are logged.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # Tracebacks can't be formatted once the frames are gone
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            METRICS.inc("webserver_log_records_dropped_total")
+
+
+def parse_mapping(text, convert):
+    """
+    Parse 'key=value,key=value' into a dictionary, converting the values.
+    """
+    mapping = {}
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        key, _, value = item.rpartition('=')
+        mapping[key.strip()] = convert(value.strip())
+    return mapping
+
+
+def setup_logging(handlers, level=logging.INFO, queue_size=10000, sample_rates=None,
+                  levels=None):
+    """
+    Route every record through a bounded queue to the handlers, which a
+    listener thread runs. The listener is stopped, and the queue drained, at exit.
+
+    Args:
+        handlers (list): The handlers actually writing the records.
+        level (int): Level of the root logger.
+        queue_size (int): Records the queue holds before new ones are dropped.
+        sample_rates (dict): Per-route sampling, see RouteFilter.
+        levels (dict): Per-route levels, see RouteFilter.
+
+    Returns:
+        DroppingQueueHandler: The handler installed on the root logger.
+    """
+    log_queue = Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RouteFilter(sample_rates, levels))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = queue_handler.listener = QueueListener(log_queue, *handlers,
+                                                      respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+
+def stop_logging():
+    """
+    Stop the listener thread after it drained the queue, and attach its handlers
+    to the root logger directly, so records are written on the logging thread.
+    A process must not fork while the listener runs; setup_logging() can be
+    called again afterwards.
+    """
+    root = logging.getLogger()
+    for queue_handler in list(root.handlers):
+        if isinstance(queue_handler, DroppingQueueHandler) and queue_handler.listener:
+            queue_handler.listener.stop()
+            atexit.unregister(queue_handler.listener.stop)
+            root.removeHandler(queue_handler)
+            for handler in queue_handler.listener.handlers:
+                root.addHandler(handler)
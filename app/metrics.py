@@ -0,0 +1,145 @@
+"""
+Cheap in-process metrics, exported in the Prometheus text format.
+"""
+import bisect
+import weakref
+from threading import local, Lock
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Metrics:
+    """
+    Counters and histograms recorded per thread and merged when scraped.
+
+    Each thread only ever writes its own dictionaries, so recording takes no lock;
+    the lock is only taken once per thread, to register its storage, when the
+    thread exits and its storage is folded into those of the exited threads, and
+    by the scrape that walks every live thread's storage.
+    """
+    def __init__(self):
+        self.local = local()
+        self.lock = Lock()
+        # Storages of the live threads, by an id of their own
+        self.storages = {}
+        # Counters and histograms of the threads that exited
+        self.retired = ({}, {})
+
+    def _storage(self):
+        storage = getattr(self.local, 'storage', None)
+        if storage is None:
+            storage = self.local.storage = ({}, {})
+            # The owner is only referenced by the thread's local data, so it is
+            # collected, and the storage retired, as soon as the thread exits
+            owner = self.local.owner = _Owner()
+            with self.lock:
+                self.storages[id(owner)] = storage
+            weakref.finalize(owner, self._retire, id(owner))
+        return storage
+
+    def _retire(self, key):
+        with self.lock:
+            counters, histograms = self.storages.pop(key)
+            _merge(self.retired, counters, histograms)
+
+    def inc(self, name, labels=(), amount=1):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): Metric name.
+            labels (tuple): (label, value) pairs.
+            amount (float): Increment.
+        """
+        counters = self._storage()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """
+        Record a value, usually a duration in seconds, in a histogram.
+        """
+        histograms = self._storage()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Bucket counts, with a last bucket for +Inf, then the sum
+            histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def render(self, collected=()):
+        """
+        Merge every thread's metrics and format them with metrics collected at
+        scrape time.
+
+        Args:
+            collected (list): (name, type, [(labels, value), ...]) tuples, where type
+                is 'counter' or 'gauge'.
+        """
+        merged = ({}, {})
+        with self.lock:
+            storages = list(self.storages.values())
+            _merge(merged, *self.retired)
+        for thread_counters, thread_histograms in storages:
+            _merge(merged, thread_counters, thread_histograms)
+        counters, histograms = merged
+
+        lines = []
+        for name, samples in _by_name(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+
+        for name, samples in _by_name(histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in samples:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        for name, metric_type, samples in collected:
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+
+        return "\n".join(lines) + "\n"
+
+
+class _Owner:
+    """
+    A token held by a thread's local data, whose collection retires its storage.
+    """
+
+
+def _merge(merged, counters, histograms):
+    """
+    Add counters and histograms to a (counters, histograms) pair.
+    """
+    merged_counters, merged_histograms = merged
+    for key, value in list(counters.items()):
+        merged_counters[key] = merged_counters.get(key, 0) + value
+    for key, histogram in list(histograms.items()):
+        merged_histogram = merged_histograms.setdefault(key, [0] * len(histogram))
+        for i, value in enumerate(histogram):
+            merged_histogram[i] += value
+
+
+def _by_name(items):
+    grouped = {}
+    for (name, labels), value in sorted(items, key=lambda item: item[0]):
+        grouped.setdefault(name, []).append((labels, value))
+    return grouped.items()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+# The metrics of the whole server
+METRICS = Metrics()
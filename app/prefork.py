@@ -0,0 +1,185 @@
+"""
+Pre-fork serving: one master loads the dataset, forked workers serve requests.
+
+    PREFORK_WORKERS=4 python -m app.prefork --host 0.0.0.0 --port 5000
+"""
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import sqlite3
+import logging
+import argparse
+from threading import Thread
+from werkzeug.serving import make_server
+from app import webserver, configure_logging, start_thread_pool
+from app.log_pipeline import stop_logging
+from app.sqlite_job_store import fail_owner_jobs
+
+logger = logging.getLogger(__name__)
+
+# A worker exiting sooner than this after its start is restarted only after a pause
+MIN_WORKER_LIFETIME = 1.0
+
+
+class Master:
+    """
+    Forks the workers over a shared listening socket and restarts them when
+    they exit, until it is told to stop. The jobs a worker left running in the
+    shared job store are failed when it exits, since no other worker can finish
+    them.
+
+    The dataset and its aggregate index are built before the fork and moved to
+    the permanent generation with gc.freeze(), so the collector never walks them
+    in the workers, and their pages stay shared copy-on-write. The master runs no
+    thread of its own, since a fork only copies the thread calling it.
+    """
+    def __init__(self, listener, num_workers):
+        """
+        Initialize the Master instance.
+
+        Args:
+            listener (socket.socket): The listening socket the workers accept on.
+            num_workers (int): Number of worker processes.
+        """
+        self.listener = listener
+        self.num_workers = num_workers
+        # Worker pid -> (worker index, start time)
+        self.workers = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Start the workers and supervise them until SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        stop_logging()
+        gc.collect()
+        gc.freeze()
+
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.workers.pop(pid, (None, None))
+            if index is None:
+                continue
+            self._fail_jobs(index, pid)
+            if self.stopping:
+                continue
+
+            logger.warning("Worker %d (pid %d) exited with status %d, restarting it",
+                           index, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self.stopping:
+                self._spawn(index)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve_worker(index, self.listener)
+            except BaseException:  # pylint: disable=broad-exception-caught
+                logger.exception("Worker %d failed", index)
+                code = 1
+            # The worker never returns into the master's loop
+            stop_logging()
+            os._exit(code)
+        self.workers[pid] = (index, time.monotonic())
+        logger.info("Started worker %d (pid %d)", index, pid)
+
+    def _fail_jobs(self, index, pid):
+        if os.environ.get('JOB_STORE_BACKEND') != 'sqlite':
+            return
+        try:
+            failed = fail_owner_jobs(os.environ.get('JOB_STORE_PATH', './jobs.sqlite3'), pid,
+                                     f"Worker {index} exited before finishing the job")
+        except sqlite3.Error as error:
+            logger.warning("Could not fail the jobs of worker %d (pid %d): %s", index, pid, error)
+            return
+        if failed:
+            logger.warning("Failed %d unfinished jobs of worker %d (pid %d)", failed, index, pid)
+
+    def _stop(self, _signum, _frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def serve_worker(index, listener):
+    """
+    Serve requests on the shared socket in a forked worker until SIGTERM.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit_worker)
+    Thread(target=_exit_with_master, args=(os.getppid(),), daemon=True).start()
+
+    configure_logging()
+    # Each worker needs its own result log, which it clears when it starts
+    result_log_dir = os.environ.get('RESULT_LOG_DIR', './results')
+    os.environ['RESULT_LOG_DIR'] = os.path.join(result_log_dir, f"worker-{index}")
+    start_thread_pool()
+
+    server = make_server(*listener.getsockname()[:2], webserver, threaded=True,
+                         fd=listener.fileno())
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        webserver.tasks_runner.stop()
+
+
+def _exit_worker(_signum, _frame):
+    sys.exit(0)
+
+
+def _exit_with_master(master_pid):
+    """
+    Exit the worker once the master is gone, even if it was killed.
+    """
+    while os.getppid() == master_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def main():
+    """
+    Parse the command line and run the master.
+    """
+    parser = argparse.ArgumentParser(description="Serve the webserver from pre-forked workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    num_workers = int(os.environ.get('PREFORK_WORKERS') or 0)
+    if num_workers < 1:
+        # Without it, importing the app already started a thread pool in this process
+        sys.exit("Set PREFORK_WORKERS to the number of worker processes")
+
+    # The workers must share their jobs, since any of them may get the poll of a job
+    os.environ.setdefault('JOB_STORE_BACKEND', 'sqlite')
+    if os.environ['JOB_STORE_BACKEND'] != 'sqlite':
+        logger.warning("Polls may reach another worker than the job's with JOB_STORE_BACKEND=%s",
+                       os.environ['JOB_STORE_BACKEND'])
+
+    listener = socket.create_server((args.host, args.port), backlog=1024)
+    logger.info("Serving on %s:%d with %d workers", args.host, args.port, num_workers)
+    Master(listener, num_workers).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Execution of tasks in worker processes that inherit the dataset by fork.
+"""
+import os
+import time
+import multiprocessing
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+
+# The DataIngestor a worker process inherited from the server
+_worker_data_ingestor = None
+
+
+def _inherit_worker(data_ingestor):
+    """
+    Use in a worker process the DataIngestor it inherited from the server by fork.
+    """
+    global _worker_data_ingestor  # pylint: disable=global-statement
+    _worker_data_ingestor = data_ingestor
+    Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+
+
+def _exit_with_parent(parent_pid):
+    """
+    Exit the worker once the server process is gone, even if it was killed.
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def _execute(task):
+    """
+    Execute a task in a worker process against the worker's view of the dataset.
+    """
+    task.data_ingestor = _worker_data_ingestor
+    return task.execute()
+
+
+class ProcessBackend:
+    """
+    Runs tasks in a pool of worker processes.
+
+    The workers are forked from the server once its dataset and indexes are
+    built, and use the DataIngestor they inherit: the rows and the index arrays
+    stay in pages shared copy-on-write with the server, so no worker copies or
+    rebuilds them. Tasks are pickled without their DataIngestor. Once rows are
+    appended to the dataset the workers' view is stale, and the pool's threads
+    run the tasks themselves instead.
+
+    Workers are started with the 'fork' start method: with 'spawn' they would
+    re-import the app package and start a whole server each.
+    """
+    def __init__(self, data_ingestor, num_workers):
+        """
+        Initialize the ProcessBackend instance and start its workers.
+
+        Args:
+            data_ingestor (DataIngestor): The dataset the workers inherit.
+            num_workers (int): Number of worker processes.
+
+        Raises:
+            ValueError: The platform can't fork processes.
+        """
+        # The dataset version the workers see; rows appended later are not shared
+        self.version = data_ingestor.version
+        # Arguments of forked workers are inherited rather than pickled
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=multiprocessing.get_context('fork'),
+                                            initializer=_inherit_worker,
+                                            initargs=(data_ingestor,))
+        # Fork every worker now, before the server starts more threads
+        self.executor.submit(int).result()
+
+    def execute(self, task):
+        """
+        Execute a task in one of the worker processes and return its result.
+        """
+        return self.executor.submit(_execute, task).result()
+
+    def shutdown(self):
+        """
+        Stop the worker processes.
+        """
+        self.executor.shutdown()
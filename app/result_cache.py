@@ -0,0 +1,107 @@
+"""
+Bounded LRU cache for the results of analytic tasks.
+"""
+import json
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResultCache:
+    """
+    A thread-safe LRU cache of task results, bounded both by number of entries and
+    by the approximate size of the cached results.
+
+    The cache is tagged with the version of the dataset its results were computed
+    from. Looking up a different version drops every entry, so a reload of the
+    dataset invalidates the cache.
+    """
+    def __init__(self, max_entries, max_bytes):
+        """
+        Initialize the ResultCache instance.
+
+        Args:
+            max_entries (int): Maximum number of cached results, 0 disables caching.
+            max_bytes (int): Maximum total size of the cached results, measured as
+                the length of their JSON encoding.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """
+        Look up a result.
+
+        Returns:
+            tuple: (True, result) on a hit, (False, None) on a miss.
+        """
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def contains(self, key, version):
+        """
+        Check whether a result is cached, without touching the LRU order or counters.
+        """
+        with self.lock:
+            return self.version == version and key in self.entries
+
+    def put(self, key, version, result):
+        """
+        Store a result, evicting the least recently used ones to stay within bounds.
+        """
+        size = len(json.dumps(result))
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+
+        with self.lock:
+            self._check_version(version)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (result, size)
+            self.size += size
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every cached result.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return the cache counters.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.size = 0
+            self.version = version
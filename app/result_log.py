@@ -0,0 +1,173 @@
+"""
+Append-only log of job results, written by a background thread.
+"""
+import os
+import json
+import time
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from app.metrics import METRICS
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class ResultLog(Thread):
+    """
+    A thread that appends job results to segment files in batches.
+
+    Every result is one JSON line in the active segment; an in-memory index maps
+    each job id to its segment, offset and length so results can be read back
+    after the job store has evicted them. The active segment is sealed and a new
+    one started once it grows past segment_bytes, and the oldest segments are
+    deleted beyond max_segments. Job ids are never reused, so no record is ever
+    superseded and dropping whole segments is all the compaction the log needs.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, max_segments=16,
+                 fsync_policy='interval', fsync_interval=1.0):
+        """
+        Initialize the ResultLog instance.
+
+        Segments left over from a previous run are deleted, because the job ids
+        they refer to start over with every run.
+
+        Args:
+            directory (str): Directory holding the segment files.
+            segment_bytes (int): Size after which the active segment is sealed.
+            max_segments (int): Number of segments kept, the active one included.
+            fsync_policy (str): 'always' to fsync after every batch, 'interval' to
+                fsync at most every fsync_interval seconds, 'never' to leave it to
+                the OS.
+            fsync_interval (float): Seconds between fsyncs with the 'interval' policy.
+        """
+        super().__init__(name="ResultLog")
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy!r}")
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.batch_size = 256
+
+        self.queue = Queue()
+        self.graceful_shutdown = Event()
+
+        # Results queued but not written yet, and job id -> (segment, offset, length)
+        self.lock = Lock()
+        self.pending = {}
+        self.index = {}
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith('segment-') and name.endswith('.log'):
+                os.remove(os.path.join(directory, name))
+
+        self.segments = [1]
+        self.file = open(self._segment_path(1), 'ab')  # pylint: disable=consider-using-with
+        self.last_fsync = time.monotonic()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.log")
+
+    def append(self, job_id, result):
+        """
+        Queue a result to be written; it can be read back immediately.
+        """
+        with self.lock:
+            self.pending[job_id] = result
+        self.queue.put((job_id, result))
+
+    def read(self, job_id):
+        """
+        Return the logged result of a job.
+
+        Returns:
+            tuple: (True, result) if the job's result is in the log, (False, None)
+                otherwise.
+        """
+        with self.lock:
+            if job_id in self.pending:
+                return True, self.pending[job_id]
+            location = self.index.get(job_id)
+        if location is None:
+            return False, None
+
+        segment, offset, length = location
+        try:
+            with open(self._segment_path(segment), 'rb') as file:
+                file.seek(offset)
+                return True, json.loads(file.read(length))
+        except (OSError, ValueError):
+            # The segment was deleted from under us or is incomplete
+            return False, None
+
+    def run(self):
+        """
+        Write queued results in batches until stopped, then drain the queue.
+        """
+        while not self.graceful_shutdown.is_set() or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            self._write_batch(batch)
+        self.file.close()
+
+    def _write_batch(self, batch):
+        started = time.monotonic()
+        segment = self.segments[-1]
+        offset = self.file.tell()
+        locations = {}
+        chunks = []
+        for job_id, result in batch:
+            record = json.dumps(result).encode() + b'\n'
+            locations[job_id] = (segment, offset, len(record))
+            offset += len(record)
+            chunks.append(record)
+
+        self.file.write(b''.join(chunks))
+        self.file.flush()
+        now = time.monotonic()
+        if self.fsync_policy == 'always' or \
+           (self.fsync_policy == 'interval' and now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+        with self.lock:
+            self.index.update(locations)
+            for job_id, _ in batch:
+                self.pending.pop(job_id, None)
+
+        if offset >= self.segment_bytes:
+            self._rotate()
+        METRICS.observe("webserver_result_write_seconds", (), time.monotonic() - started)
+        METRICS.inc("webserver_results_written_total", (), len(batch))
+
+    def _rotate(self):
+        if self.fsync_policy != 'never':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.file = open(self._segment_path(self.segments[-1]), 'ab')  # pylint: disable=consider-using-with
+
+        while len(self.segments) > self.max_segments:
+            dropped = self.segments.pop(0)
+            with self.lock:
+                self.index = {job_id: location for job_id, location in self.index.items()
+                              if location[0] != dropped}
+            try:
+                os.remove(self._segment_path(dropped))
+            except FileNotFoundError:
+                pass
+
+    def stop(self):
+        """
+        Stop the writer once every queued result has been written.
+        """
+        self.graceful_shutdown.set()
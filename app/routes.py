@@ -1,12 +1,64 @@
+import os
+import hmac
+import json
+import time
 import logging
+from queue import Queue, Empty
 from app import webserver
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from app.task import *
+from app.data_ingestor import DataIngestor
+from app.scheduler import SchedulerFull
+from app.metrics import METRICS
+from app.log_pipeline import LazyRepr
 
 
 # Obținem un obiect logger pentru modulele de routare
 logger = logging.getLogger(__name__)
 
+# Cât poate aștepta cel mult un long-poll, respectiv un stream de evenimente (secunde)
+LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT', 30))
+EVENTS_MAX_WAIT = float(os.environ.get('EVENTS_MAX_WAIT', 300))
+
+# Cea mai mare încărcare de rânduri noi acceptată (octeți)
+INGEST_MAX_BYTES = int(os.environ.get('INGEST_MAX_BYTES', 64 * 1024 * 1024))
+
+# Cât timp pot fi servite rezultatele din cache-ul unui proxy fără revalidare
+# (secunde); cu 0, proxy-ul revalidează fiecare cerere cu ETag-ul rezultatului
+RESULTS_MAX_AGE = int(os.environ.get('RESULTS_MAX_AGE', 0))
+RESULTS_CACHE_CONTROL = f"public, max-age={RESULTS_MAX_AGE}" if RESULTS_MAX_AGE else "no-cache"
+
+# Adresele proxy-urilor de încredere, separate prin virgulă; doar cererile venite
+# prin ele își pot declara clientul cu antetul X-Client-Id
+TRUSTED_PROXIES = {address.strip() for address in
+                   os.environ.get('TRUSTED_PROXIES', '').split(',') if address.strip()}
+
+# Formatul rândurilor noi, după Content-Type
+INGEST_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+@webserver.after_request
+def count_request(response):
+    """
+    Count every request by route, method and status code.
+    """
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    METRICS.inc("webserver_requests_total", (("endpoint", route), ("method", request.method),
+                                             ("status", str(response.status_code))))
+    return response
+
+@webserver.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Endpoint exporting the server's metrics in the Prometheus text format.
+    """
+    return Response(METRICS.render(webserver.tasks_runner.collect_metrics()),
+                    mimetype='text/plain; version=0.0.4')
+
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
 def post_endpoint():
@@ -16,7 +68,7 @@ def post_endpoint():
     if request.method == 'POST':
         # Assuming the request contains JSON data
         data = request.json
-        logger.info("Received POST data: %s", data)
+        logger.info("Received POST data: %s", LazyRepr(data))
 
         # Process the received data
         # For demonstration purposes, just echoing back the received data
@@ -33,16 +85,124 @@ def post_endpoint():
 def get_response(job_id):
     """
     Endpoint to get the status or result of a specific job.
+
+    With a 'wait' query parameter (seconds) the request blocks until the job is
+    done or the wait expires, instead of answering 'running' right away.
     """
-    job_id = int(job_id)
+    job_store = webserver.tasks_runner.job_store
+    wait = request.args.get('wait', 0, type=float)
+    if not job_id.isdigit():
+        job = None
+    elif wait > 0:
+        job = job_store.wait(int(job_id), min(wait, LONG_POLL_MAX_WAIT))
+    else:
+        job = job_store.get(int(job_id))
+
+    # Distingem între joburile expirate și id-urile care nu au existat niciodată
+    if job is None:
+        if job_id.isdigit() and job_store.is_expired(int(job_id)):
+            # Rezultatele joburilor evacuate pot fi citite înapoi din jurnalul de rezultate
+            logged, result = webserver.tasks_runner.result_log.read(int(job_id))
+            if logged:
+                logger.info("Job %s is done with logged result: %s", job_id, LazyRepr(result))
+                return jsonify({"status": "done", "data": result}), 200
+            logger.info("Job %s has expired", job_id)
+            return jsonify({"status": "expired", "reason": f"Job {job_id} has expired"}), 410
+        logger.error("Invalid job_id %s", job_id)
+        return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
+
     # Verificăm dacă task-ul asociat cu job_id-ul este finalizat
-    if webserver.tasks_runner.dictionary[job_id]["status"] == "running":
+    if job["status"] == "running":
         logger.info("Job %s is still running", job_id)
-        return jsonify({'status': 'running'}), 200
+        response = jsonify({'status': 'running'})
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
+
+    # Clientul are deja rezultatul, deci nu îl mai serializăm
+    etag = job.get("etag")
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        logger.info("Job %s is done and not modified", job_id)
+        return not_modified(etag)
 
     # Dacă task-ul este finalizat, returnăm rezultatul
-    logger.info("Job %s is done with result: %s", job_id, webserver.tasks_runner.dictionary[job_id]['result'])
-    return jsonify({"status": "done", "data": webserver.tasks_runner.dictionary[job_id]["result"]}), 200
+    logger.info("Job %s is done with result: %s", job_id, LazyRepr(job['result']))
+    return tagged(jsonify({"status": "done", "data": job["result"]}), etag), 200
+
+@webserver.route('/api/events', methods=['GET'])
+def job_events():
+    """
+    Endpoint streaming server-sent events as the jobs in 'job_ids' (comma
+    separated) finish. The stream ends once every job was reported or after
+    'timeout' seconds.
+    """
+    job_store = webserver.tasks_runner.job_store
+    job_ids = list(dict.fromkeys(int(job_id) for job_id in
+                                 request.args.get('job_ids', '').split(',') if job_id.isdigit()))
+    timeout = min(request.args.get('timeout', EVENTS_MAX_WAIT, type=float), EVENTS_MAX_WAIT)
+    logger.info("Streaming events for jobs %s", LazyRepr(job_ids))
+
+    # Callback-urile sunt apelate de thread-ul care termină jobul
+    completions = Queue()
+
+    def on_done(job_id, job):
+        completions.put((job_id, job))
+
+    for job_id in job_ids:
+        if not job_store.subscribe(job_id, on_done):
+            completions.put((job_id, None))
+
+    def stream():
+        deadline = time.monotonic() + timeout
+        remaining = len(job_ids)
+        try:
+            while remaining:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    job_id, job = completions.get(timeout=min(left, 15))
+                except Empty:
+                    # Comentariile SSE țin conexiunea deschisă prin proxy-uri
+                    yield ": keep-alive\n\n"
+                    continue
+                remaining -= 1
+                yield format_job_event(job_id, job)
+        finally:
+            for job_id in job_ids:
+                job_store.unsubscribe(job_id, on_done)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def not_modified(etag):
+    """
+    Answer 304, without a body, a client whose copy tagged with etag is current.
+    """
+    return tagged(Response(status=304), etag)
+
+def tagged(response, etag):
+    """
+    Add the ETag, if any, and the caching policy of results to a response.
+    """
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = RESULTS_CACHE_CONTROL
+    return response
+
+def format_job_event(job_id, job):
+    """
+    Format a finished, expired or unknown job as a server-sent event.
+    """
+    if job is not None:
+        event = {"job_id": job_id, "status": "done", "data": job["result"]}
+    elif webserver.tasks_runner.job_store.is_expired(job_id):
+        logged, result = webserver.tasks_runner.result_log.read(job_id)
+        if logged:
+            event = {"job_id": job_id, "status": "done", "data": result}
+        else:
+            event = {"job_id": job_id, "status": "expired"}
+    else:
+        event = {"job_id": job_id, "status": "error", "reason": "Invalid job_id"}
+    return f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
 
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
@@ -51,9 +211,9 @@ def get_jobs():
     """
     # Construim o listă de dicționare pentru fiecare job_id și statusul său
     jobs = []
-    for job_id, job_info in webserver.tasks_runner.dictionary.items():
-        jobs.append({f"job_id_{job_id}": job_info["status"]})
-    logger.info("Retrieving jobs status: %s", jobs)
+    for job_id, status in webserver.tasks_runner.job_store.statuses():
+        jobs.append({f"job_id_{job_id}": status})
+    logger.info("Retrieving jobs status: %s", LazyRepr(jobs))
 
     # Construim obiectul JSON cu lista de dicționare
     response_data = {"status": "done", "data": jobs}
@@ -67,12 +227,79 @@ def get_num_jobs():
     Endpoint to get the number of remaining jobs in the queue.
     """
     # Obținem numărul de joburi rămase de procesat
-    num_jobs = webserver.tasks_runner.task_queue.qsize()
+    num_jobs = webserver.tasks_runner.num_pending()
     logger.info("Number of jobs remaining: %s", num_jobs)
 
     # Returnăm numărul de joburi sub formă de JSON
     return jsonify({"status": "done", "num_jobs": num_jobs})
 
+def submit_task(task):
+    """
+    Queue a task and answer 202 with its job id.
+
+    A client can opt into a synchronous answer with an 'X-Sync: 1' header or a
+    'sync=1' query parameter. The task is then answered inline with 200 if its
+    result is cached or it is cheap enough, and queued as usual otherwise.
+
+    Results carry an ETag derived from the dataset version and the task's
+    parameters. A client sending it back in If-None-Match gets 304 as long as
+    the data is unchanged, without the task being queued or executed.
+    """
+    # Anii intră în cheia din cache, deci sunt verificați înainte de planificare
+    if not task.is_valid_year_range():
+        return jsonify({"status": "error",
+                        "reason": "year_start and year_end must be integers"}), 400
+
+    # Cheia din cache trebuie să poată fi folosită într-un dicționar
+    if not task.is_valid_key():
+        return jsonify({"status": "error",
+                        "reason": "Parameters must be strings, numbers or lists of numbers"}), 400
+
+    etag = task.etag(webserver.data_ingestor.version)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if wants_sync():
+        answered, result = webserver.tasks_runner.try_execute_inline(task)
+        if answered:
+            # Erorile task-urilor sunt perechi (corp, cod de status)
+            if isinstance(result, tuple):
+                body, status = result
+                return jsonify(body), status
+            return tagged(jsonify({"status": "done", "data": result}), etag), 200
+
+    # Adăugăm task-ul în coada de task-uri a thread pool-ului; cererile sunt
+    # planificate echitabil între clienți
+    client = client_identity()
+    try:
+        job_id = webserver.tasks_runner.add_task(task, client)
+    except SchedulerFull as error:
+        logger.warning("Refused job from %s: %s", client, error)
+        response = jsonify({"status": "error", "reason": str(error)})
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    # Returnăm un răspuns imediat pentru a confirma primirea cererii
+    response = jsonify({"status": "done", "job_id": job_id})
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 202
+
+def client_identity():
+    """
+    Return who submitted the request, for fair queueing: its address, or the
+    X-Client-Id header it sent through a trusted proxy.
+    """
+    if request.remote_addr in TRUSTED_PROXIES:
+        return request.headers.get('X-Client-Id', request.remote_addr)
+    return request.remote_addr
+
+def wants_sync():
+    """
+    Check whether the client asked for a synchronous answer.
+    """
+    flag = request.headers.get('X-Sync', request.args.get('sync', ''))
+    return flag.lower() in ('1', 'true', 'yes')
+
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
     """
@@ -80,16 +307,13 @@ def states_mean_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for states mean with data: %s" , data)
+    logger.info("Received request for states mean with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de media statelor
-    task = StatesMeanTask(data['question'], webserver.data_ingestor.data)
-
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    task = create_task('states_mean', data, webserver.data_ingestor)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
@@ -98,16 +322,13 @@ def state_mean_request():
     """
     # Obținem datele din cerere
     data = request.json
-    logger.info("Received request for state mean with data: %s", data)
+    logger.info("Received request for state mean with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de media statului
-    task = StateMeanTask(data['question'], data['state'], webserver.data_ingestor.data)
+    task = create_task('state_mean', data, webserver.data_ingestor)
 
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
-
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/best5', methods=['POST'])
 def best5_request():
@@ -116,16 +337,13 @@ def best5_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for best 5 with data: %s", data)
+    logger.info("Received request for best 5 with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de best5
-    task = Best5Task(data['question'], webserver.data_ingestor.data)
-
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    task = create_task('best5', data, webserver.data_ingestor)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
@@ -134,16 +352,29 @@ def worst5_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for worst 5 with data: %s", data)
+    logger.info("Received request for worst 5 with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de worst5
-    task = Worst5Task(data['question'], webserver.data_ingestor.data)
+    task = create_task('worst5', data, webserver.data_ingestor)
 
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+@webserver.route('/api/topk', methods=['POST'])
+def topk_request():
+    """
+    Endpoint to request the k best or worst states, optionally within a
+    stratification segment.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for top k with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de topk
+    task = create_task('topk', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
@@ -152,16 +383,13 @@ def global_mean_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for global mean with data: %s", data)
+    logger.info("Received request for global mean with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de global_mean
-    task = GlobalMeanTask(data['question'], webserver.data_ingestor.data)
-
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    task = create_task('global_mean', data, webserver.data_ingestor)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
@@ -170,16 +398,13 @@ def diff_from_mean_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for diff from mean with data: %s", data)
+    logger.info("Received request for diff from mean with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de diff_from_mean
-    task = DiffFromMeanTask(data['question'], webserver.data_ingestor.data)
-
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    task = create_task('diff_from_mean', data, webserver.data_ingestor)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
@@ -188,16 +413,13 @@ def state_diff_from_mean_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for state diff from mean with data: %s", data)
+    logger.info("Received request for state diff from mean with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de state_diff_from_mean
-    task = StateDiffFromMeanTask(data['question'], data['state'], webserver.data_ingestor.data)
+    task = create_task('state_diff_from_mean', data, webserver.data_ingestor)
 
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
-
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
@@ -206,16 +428,13 @@ def mean_by_category_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for mean by category with data: %s", data)
+    logger.info("Received request for mean by category with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de mean_by_category
-    task = MeanByCategoryTask(data['question'], webserver.data_ingestor.data)
+    task = create_task('mean_by_category', data, webserver.data_ingestor)
 
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
-
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
@@ -224,16 +443,170 @@ def state_mean_by_category_request():
     """
     # Obține datele din cerere
     data = request.json
-    logger.info("Received request for state mean by category with data: %s", data)
+    logger.info("Received request for state mean by category with data: %s", LazyRepr(data))
 
     # Creăm un obiect Task specific pentru cererea de state_mean_by_category
-    task = StateMeanByCategoryTask(data['question'], data['state'], webserver.data_ingestor.data)
+    task = create_task('state_mean_by_category', data, webserver.data_ingestor)
 
-    # Adăugăm task-ul în coada de task-uri a thread pool-ului
-    job_id = webserver.tasks_runner.add_task(task)
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
 
-    # Returnăm un răspuns imediat pentru a confirma primirea cererii
-    return jsonify({"status": "done", "job_id": job_id}), 202
+@webserver.route('/api/states_quantiles', methods=['POST'])
+def states_quantiles_request():
+    """
+    Endpoint to request quantiles of the values of every state.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for states quantiles with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de quantilele tuturor statelor
+    task = create_task('states_quantiles', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/state_quantiles', methods=['POST'])
+def state_quantiles_request():
+    """
+    Endpoint to request quantiles of the values of a specific state.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for state quantiles with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de quantilele statului
+    task = create_task('state_quantiles', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/global_quantiles', methods=['POST'])
+def global_quantiles_request():
+    """
+    Endpoint to request quantiles of the values over all states.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for global quantiles with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de quantilele globale
+    task = create_task('global_quantiles', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/states_stddev', methods=['POST'])
+def states_stddev_request():
+    """
+    Endpoint to request the standard deviation of every state.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for states stddev with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de deviația standard a tuturor statelor
+    task = create_task('states_stddev', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/state_stddev', methods=['POST'])
+def state_stddev_request():
+    """
+    Endpoint to request the standard deviation of a specific state.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for state stddev with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de deviația standard a statului
+    task = create_task('state_stddev', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/global_stddev', methods=['POST'])
+def global_stddev_request():
+    """
+    Endpoint to request the standard deviation over all states.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received request for global stddev with data: %s", LazyRepr(data))
+
+    # Creăm un obiect Task specific pentru cererea de deviația standard globală
+    task = create_task('global_stddev', data, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """
+    Endpoint to request the results of several analytic queries as one job.
+    """
+    # Obține datele din cerere
+    data = request.json
+    logger.info("Received batch request with data: %s", LazyRepr(data))
+
+    # Verificăm că fiecare interogare numește un endpoint analitic cunoscut
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or \
+       not all(isinstance(query, dict) and query.get('endpoint') in TASKS_BY_ENDPOINT
+               for query in queries):
+        logger.error("Invalid batch request")
+        return jsonify({"status": "error",
+                        "reason": "Expected a list of queries with known endpoints"}), 400
+
+    # Creăm un obiect Task care răspunde tuturor interogărilor
+    task = BatchTask(queries, webserver.data_ingestor)
+
+    # Adăugăm task-ul în coada de task-uri sau îl rezolvăm imediat, la cerere
+    return submit_task(task)
+
+@webserver.route('/api/ingest', methods=['POST'])
+def ingest_request():
+    """
+    Endpoint appending new rows, as CSV or NDJSON, to the dataset.
+
+    The request must carry 'Authorization: Bearer <INGEST_TOKEN>'; without an
+    INGEST_TOKEN the endpoint is disabled. The rows are validated and folded into
+    the aggregates before the answer, so they are queryable right after it.
+    """
+    token = os.environ.get('INGEST_TOKEN')
+    if not token:
+        return jsonify({"status": "error", "reason": "Ingestion is disabled"}), 403
+
+    # Rândurile ar ajunge doar în worker-ul care a primit cererea
+    if os.environ.get('PREFORK_WORKERS'):
+        return jsonify({"status": "error",
+                        "reason": "Ingestion is not supported with pre-forked workers"}), 409
+
+    # Comparăm în timp constant, ca token-ul să nu poată fi ghicit după durata răspunsului
+    supplied = request.headers.get('Authorization', '').encode()
+    if not hmac.compare_digest(supplied, f"Bearer {token}".encode()):
+        logger.warning("Refused ingestion from %s", request.remote_addr)
+        response = jsonify({"status": "error", "reason": "Invalid credentials"})
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response, 401
+
+    data_format = INGEST_FORMATS.get(request.mimetype)
+    if data_format is None:
+        return jsonify({"status": "error",
+                        "reason": "Expected text/csv or application/x-ndjson"}), 415
+    if request.content_length is not None and request.content_length > INGEST_MAX_BYTES:
+        return jsonify({"status": "error", "reason": "Payload too large"}), 413
+
+    try:
+        rows = DataIngestor.read_rows(request.get_data(), data_format)
+    except ValueError as error:
+        logger.error("Invalid rows for ingestion: %s", error)
+        return jsonify({"status": "error", "reason": str(error)}), 400
+
+    # Rezultatele din cache sunt invalidate de noua versiune a setului de date
+    version = webserver.data_ingestor.append(rows)
+    return jsonify({"status": "done", "rows": len(rows), "version": version}), 200
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown_request():
@@ -0,0 +1,126 @@
+"""
+Bounded job queue with priority classes and per-client fair queueing.
+"""
+import time
+from collections import deque
+from queue import Empty
+from threading import Condition
+
+
+class SchedulerFull(Exception):
+    """
+    Raised when a job is refused because the queue is at its limit.
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """
+    A drop-in replacement for the pool's Queue.
+
+    Every job goes to a priority class, and within a class to the queue of the
+    client that submitted it. Classes are served by weighted round robin, so the
+    cheap classes go first without starving the expensive ones, and within a class
+    clients take turns, so a single client flooding the server only delays itself.
+    The number of queued jobs is bounded both overall and per client.
+    """
+    def __init__(self, weights=(4, 2, 1), max_queued=10000, max_per_client=1000,
+                 retry_after=1):
+        """
+        Initialize the FairScheduler instance.
+
+        Args:
+            weights (tuple): How many jobs of each priority class, from the most to
+                the least urgent, are served per round.
+            max_queued (int): Maximum number of queued jobs overall.
+            max_per_client (int): Maximum number of queued jobs of one client.
+            retry_after (int): Seconds suggested to refused clients before retrying.
+
+        Raises:
+            ValueError: A weight is below 1, so its class would never be served.
+        """
+        if not weights or min(weights) < 1:
+            raise ValueError(f"Scheduler weights must be at least 1, got {list(weights)}")
+
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.retry_after = retry_after
+
+        # The round robin order of the priority classes, e.g. 0 0 0 0 1 1 2
+        self.schedule = [level for level, weight in enumerate(weights) for _ in range(weight)]
+        self.position = 0
+
+        # For each priority class: client -> deque of jobs, and the clients with
+        # queued jobs in the order they take turns
+        self.client_queues = [{} for _ in weights]
+        self.turns = [deque() for _ in weights]
+        self.queued_per_client = {}
+        self.size = 0
+        self.condition = Condition()
+
+    def put(self, item, priority=0, client=None):
+        """
+        Queue an item for a client.
+
+        Raises:
+            SchedulerFull: The queue or the client's share of it is full.
+        """
+        priority = min(max(priority, 0), len(self.client_queues) - 1)
+        with self.condition:
+            if self.size >= self.max_queued:
+                raise SchedulerFull("Job queue is full", self.retry_after)
+            if self.queued_per_client.get(client, 0) >= self.max_per_client:
+                raise SchedulerFull("Too many queued jobs for this client", self.retry_after)
+
+            queues = self.client_queues[priority]
+            if client not in queues:
+                queues[client] = deque()
+                self.turns[priority].append(client)
+            queues[client].append((item, time.monotonic()))
+
+            self.queued_per_client[client] = self.queued_per_client.get(client, 0) + 1
+            self.size += 1
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Remove and return the next item, waiting up to timeout seconds for one.
+
+        Returns:
+            tuple: (item, seconds the item waited in the queue).
+
+        Raises:
+            Empty: No item arrived before the timeout.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.size > 0, timeout):
+                raise Empty
+
+            # Advance the round robin to the next class with queued jobs
+            while True:
+                priority = self.schedule[self.position]
+                self.position = (self.position + 1) % len(self.schedule)
+                if self.turns[priority]:
+                    break
+
+            client = self.turns[priority].popleft()
+            queue = self.client_queues[priority][client]
+            item, enqueued_at = queue.popleft()
+            if queue:
+                self.turns[priority].append(client)
+            else:
+                del self.client_queues[priority][client]
+
+            self.queued_per_client[client] -= 1
+            if not self.queued_per_client[client]:
+                del self.queued_per_client[client]
+            self.size -= 1
+            return item, time.monotonic() - enqueued_at
+
+    def qsize(self):
+        """
+        Return the number of queued items.
+        """
+        return self.size
@@ -0,0 +1,146 @@
+"""
+Binary snapshots of the ingested dataset.
+
+A snapshot file holds a magic string, the length of a JSON metadata header, the
+header itself and then one raw array per column, each aligned so it can be
+memory-mapped in place. Categorical columns are stored as their integer codes,
+with the lookup table of distinct values kept in the header.
+"""
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+import pandas as pd
+
+MAGIC = b'NUTRSNP1'
+ALIGNMENT = 64
+_LENGTH = struct.Struct('<Q')
+
+# What reading a truncated or corrupt snapshot may raise; such a snapshot is stale
+READ_ERRORS = (OSError, ValueError, KeyError, TypeError, struct.error)
+
+
+def file_digest(path):
+    """
+    Return the SHA-256 hex digest of a file, read in 1 MiB blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_metadata(csv_path):
+    """
+    Describe the source CSV so a snapshot can be matched against it.
+    """
+    stat = os.stat(csv_path)
+    return {
+        'source_sha256': file_digest(csv_path),
+        'source_mtime': stat.st_mtime,
+        'source_size': stat.st_size,
+    }
+
+
+def write_snapshot(path, data_frame, metadata):
+    """
+    Write a DataFrame of categorical and numeric columns to a snapshot file.
+
+    The file is written under a temporary name and renamed into place, so a
+    concurrent reader never sees a partial snapshot.
+
+    Args:
+        path (str): Destination of the snapshot.
+        data_frame (pd.DataFrame): The columns to store.
+        metadata (dict): Extra header fields, usually from source_metadata().
+    """
+    arrays = []
+    columns = []
+    for name in data_frame.columns:
+        column = data_frame[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            array = np.ascontiguousarray(column.cat.codes.to_numpy())
+            categories = column.cat.categories.tolist()
+        else:
+            array = np.ascontiguousarray(column.to_numpy())
+            categories = None
+        arrays.append(array)
+        columns.append({'name': name, 'dtype': array.dtype.str, 'categories': categories})
+
+    # The offsets depend on the header length, so lay out the arrays after a
+    # header rendered with zero offsets and grow it until the offsets fit
+    offset_base = 0
+    while True:
+        offset = offset_base
+        for column, array in zip(columns, arrays):
+            column['offset'] = offset
+            offset = _align(offset + array.nbytes)
+        header = json.dumps(dict(metadata, rows=len(data_frame), columns=columns)).encode()
+        data_start = _align(len(MAGIC) + _LENGTH.size + len(header))
+        if data_start <= offset_base:
+            break
+        offset_base = data_start
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(_LENGTH.pack(len(header)))
+        file.write(header)
+        for column, array in zip(columns, arrays):
+            file.write(b'\0' * (column['offset'] - file.tell()))
+            file.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_header(path):
+    """
+    Return the metadata header of a snapshot file, or None if it isn't one or
+    is too short to hold the columns its header lists.
+
+    Raises:
+        One of READ_ERRORS: The file is truncated or its header is corrupt.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            return None
+        (length,) = _LENGTH.unpack(file.read(_LENGTH.size))
+        header = json.loads(file.read(length))
+        size = os.fstat(file.fileno()).st_size
+
+    rows = header['rows']
+    if any(column['offset'] + rows * np.dtype(column['dtype']).itemsize > size
+           for column in header['columns']):
+        return None
+    return header
+
+
+def read_snapshot(path, header):
+    """
+    Memory-map the columns of a snapshot file into a DataFrame.
+
+    Args:
+        path (str): The snapshot file.
+        header (dict): Its header, as returned by read_snapshot_header().
+
+    Raises:
+        One of READ_ERRORS: The file changed since its header was read, or its
+            categorical codes are out of range.
+    """
+    rows = header['rows']
+    columns = {}
+    for column in header['columns']:
+        dtype = np.dtype(column['dtype'])
+        if rows:
+            array = np.memmap(path, dtype=dtype, mode='r', offset=column['offset'], shape=(rows,))
+        else:
+            array = np.empty(0, dtype=dtype)
+        if column['categories'] is not None:
+            array = pd.Categorical.from_codes(array, categories=column['categories'])
+        columns[column['name']] = array
+    return pd.DataFrame(columns, copy=False)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,299 @@
+"""
+Job registry kept in a SQLite database, shared by every server process using it.
+"""
+import os
+import json
+import time
+import sqlite3
+from threading import Thread, Lock, Event, local
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    result TEXT,
+    queue_wait REAL,
+    finished_at REAL,
+    etag TEXT,
+    owner INTEGER,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+"""
+
+# Columns added after the first version of the schema, with their types
+ADDED_COLUMNS = {'etag': 'TEXT', 'owner': 'INTEGER', 'created_at': 'REAL'}
+
+
+class SqliteJobStore:
+    """
+    A drop-in replacement for JobStore whose jobs live in a SQLite database in WAL
+    mode, so several server processes behind one load balancer can each answer
+    for the jobs of the others.
+
+    Ids come from an AUTOINCREMENT column, so they are unique across every process
+    and restart using the database. A job finished by this process wakes its
+    subscribers right away; jobs finished by other processes are noticed by a
+    watcher thread polling for the jobs that have subscribers, which also evicts
+    the finished jobs that are due.
+
+    Every job records the pid of the process that queued it, so the jobs of a
+    process that died can be failed with fail_owner_jobs() instead of staying
+    running forever; jobs still running after running_ttl seconds are failed as
+    well.
+    """
+    shared = True
+
+    def __init__(self, path, ttl=None, max_entries=None, poll_interval=0.05,
+                 running_ttl=None):
+        """
+        Initialize the SqliteJobStore instance.
+
+        Args:
+            path (str): The database file, created if missing.
+            ttl (float): Seconds a finished job is kept, None to keep it until
+                max_entries forces it out.
+            max_entries (int): Maximum number of stored jobs, None for no limit.
+                Jobs that have not finished yet are never evicted.
+            poll_interval (float): Seconds between checks for jobs finished by
+                other processes.
+            running_ttl (float): Seconds after which a job that is still running
+                is failed, None to wait for it forever.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.poll_interval = poll_interval
+        self.running_ttl = running_ttl
+        self.local = local()
+
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+            # Databases created by earlier versions lack the newer columns
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+        # Callbacks waiting on jobs, by job id
+        self.lock = Lock()
+        self.listeners = {}
+        self.evictions = 0
+
+        self.watcher = Thread(target=self._watch, name="JobStoreWatcher", daemon=True)
+        self.watcher.start()
+
+    def _connection(self):
+        # Connections can't be shared between threads, so each thread opens its own
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def create(self):
+        """
+        Allocate a new job id and register the job as running, owned by this process.
+        """
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (status, owner, created_at) VALUES ('running', ?, ?)",
+            (os.getpid(), time.time()))
+        return cursor.lastrowid
+
+    def start(self, job_id, queue_wait):
+        """
+        Record how long a job waited in the queue before a thread picked it up.
+        """
+        self._connection().execute("UPDATE jobs SET queue_wait = ? WHERE id = ?",
+                                   (queue_wait, job_id))
+
+    def discard(self, job_id):
+        """
+        Forget a job that was refused before it could be queued.
+        """
+        self._connection().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def finish(self, job_id, result, etag=None):
+        """
+        Record the result of a job, and the ETag it is served with, if any, then
+        notify whoever waits on it in this process.
+        """
+        self._connection().execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished_at = ?, etag = ? WHERE id = ?",
+            (json.dumps(result), time.time(), etag, job_id))
+        self._notify(job_id)
+
+    def get(self, job_id):
+        """
+        Return the status and result of a job, or None if it isn't stored.
+        """
+        row = self._connection().execute(
+            "SELECT status, result, queue_wait, etag FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else _job(*row)
+
+    def subscribe(self, job_id, callback):
+        """
+        Call callback(job_id, job) once the job is done, right away if it already is.
+        The callback runs on the thread noticing the job is done, so it must be quick.
+
+        Returns:
+            bool: False if the job isn't stored, in which case the callback is
+                never called.
+        """
+        # Registered before the job is read, so a job finishing in between isn't missed
+        with self.lock:
+            self.listeners.setdefault(job_id, []).append(callback)
+
+        job = self.get(job_id)
+        if job is None:
+            self.unsubscribe(job_id, callback)
+            return False
+        if job["status"] == "done":
+            self._notify(job_id, job)
+        return True
+
+    def unsubscribe(self, job_id, callback):
+        """
+        Stop waiting on a job with a callback passed to subscribe().
+        """
+        with self.lock:
+            callbacks = self.listeners.get(job_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.listeners.pop(job_id, None)
+
+    def wait(self, job_id, timeout):
+        """
+        Block until a job is done or the timeout expires.
+
+        Returns:
+            dict: The job as get() would return it afterwards.
+        """
+        done = Event()
+
+        def on_done(_job_id, _job):
+            done.set()
+
+        if self.subscribe(job_id, on_done):
+            done.wait(timeout)
+            self.unsubscribe(job_id, on_done)
+        return self.get(job_id)
+
+    def is_expired(self, job_id):
+        """
+        Check whether a job id was handed out but its job has since been evicted.
+        """
+        row = self._connection().execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'jobs'").fetchone()
+        return row is not None and 0 < job_id <= row[0] and self.get(job_id) is None
+
+    def items(self):
+        """
+        Return a list of (job id, job) pairs of the stored jobs, ordered by id.
+        """
+        rows = self._connection().execute(
+            "SELECT id, status, result, queue_wait, etag FROM jobs ORDER BY id")
+        return [(job_id, _job(*job)) for job_id, *job in rows]
+
+    def statuses(self):
+        """
+        Return a list of (job id, status) pairs of the stored jobs, ordered by id,
+        without reading their results.
+        """
+        return self._connection().execute("SELECT id, status FROM jobs ORDER BY id").fetchall()
+
+    def count_running(self):
+        """
+        Return the number of jobs of every process that aren't done yet.
+        """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def _notify(self, job_id, job=None):
+        with self.lock:
+            callbacks = self.listeners.pop(job_id, [])
+        if callbacks and job is None:
+            job = self.get(job_id)
+        for callback in callbacks:
+            callback(job_id, job)
+
+    def _watch(self):
+        """
+        Wake the subscribers of jobs finished elsewhere, and evict the finished
+        jobs that are due about once a second.
+        """
+        last_eviction = 0.0
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                watched = list(self.listeners)
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(watched), 500):
+                chunk = watched[start:start + 500]
+                rows = self._connection().execute(
+                    f"SELECT id FROM jobs WHERE status = 'done' AND id IN "
+                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                for (job_id,) in rows:
+                    self._notify(job_id)
+
+            if time.monotonic() - last_eviction >= 1:
+                last_eviction = time.monotonic()
+                self._evict()
+
+    def _evict(self):
+        connection = self._connection()
+        if self.running_ttl is not None:
+            # Jobs created before the column existed count as created long ago
+            fail_jobs(connection, "IFNULL(created_at, 0) < ?", (time.time() - self.running_ttl,),
+                      f"Job did not finish within {self.running_ttl:g} seconds")
+        if self.ttl is not None:
+            cursor = connection.execute("DELETE FROM jobs WHERE finished_at < ?",
+                                        (time.time() - self.ttl,))
+            self.evictions += cursor.rowcount
+        if self.max_entries is not None:
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                cursor = connection.execute(
+                    "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status = 'done' "
+                    "ORDER BY finished_at LIMIT ?)", (excess,))
+                self.evictions += cursor.rowcount
+
+
+def fail_jobs(connection, condition, parameters, message):
+    """
+    Finish the running jobs matching an SQL condition with an error.
+
+    Returns:
+        int: Number of jobs failed.
+    """
+    result = json.dumps(({"status": "error", "message": message}, 500))
+    cursor = connection.execute(
+        f"UPDATE jobs SET status = 'done', result = ?, finished_at = ? "
+        f"WHERE status = 'running' AND {condition}", (result, time.time()) + parameters)
+    return cursor.rowcount
+
+
+def fail_owner_jobs(path, pid, message):
+    """
+    Fail the running jobs of a process that died, in the database at path, from
+    a process that doesn't use the database otherwise.
+
+    Returns:
+        int: Number of jobs failed.
+    """
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        return fail_jobs(connection, "owner = ?", (pid,), message)
+    finally:
+        connection.close()
+
+
+def _job(status, result, queue_wait, etag):
+    return {"status": status, "result": None if result is None else json.loads(result),
+            "queue_wait": queue_wait, "etag": etag}
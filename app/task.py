@@ -1,11 +1,28 @@
-from app import webserver
+import hashlib
+import numpy as np
+from app.aggregate_index import mean_of
+from app.distribution_index import EMPTY as EMPTY_DISTRIBUTION
 
 class Task:
     """
     Base class for tasks.
     """
-    def __init__(self, data_frame):
-        self.data_frame = data_frame
+    # Scheduling class: 0 for single lookups, 1 for per-state scans, 2 for the
+    # largest results
+    priority = 1
+
+    # Key of the job the pool runs for the task, set when it is queued
+    inflight_key = None
+
+    # Years the task is restricted to, both included, set by create_task(); None
+    # leaves that end of the range open
+    year_start = None
+    year_end = None
+
+    def __init__(self, question, data_ingestor, state=None):
+        self.question = question
+        self.data_ingestor = data_ingestor
+        self.state = state
 
     def execute(self):
         """
@@ -13,296 +30,655 @@ class Task:
         """
         raise NotImplementedError("Method 'execute' must be implemented in subclasses")
 
-class StateMeanTask:
+    def __getstate__(self):
+        # Tasks sent to worker processes use the worker's own view of the dataset
+        state = self.__dict__.copy()
+        state['data_ingestor'] = None
+        return state
+
+    def cache_key(self):
+        """
+        Return a key identifying the task's result among all tasks.
+        """
+        return (type(self).__name__, self.question, self.state, self.year_start, self.year_end)
+
+    def etag(self, version):
+        """
+        Return the strong ETag of the task's result on a version of the dataset.
+
+        The result only depends on the data and the task's parameters, so the tag
+        is a hash of the dataset's identity, its version and the cache key.
+        """
+        key = repr((self.data_ingestor.identity, version) + self.cache_key())
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def estimated_cost(self):
+        """
+        Estimate the work of the task as the number of index entries it reads.
+        """
+        return len(self.data_ingestor.index.state_stats(self.question))
+
+    def is_valid_question(self):
+        """
+        Check if the task's question is one of the known questions.
+        """
+        return self.data_ingestor.is_valid_question(self.question)
+
+    def is_valid_key(self):
+        """
+        Check if the task's cache key is made of strings and numbers only, so it
+        can be hashed; requests with lists or objects as parameters are refused.
+        """
+        return is_plain_key(self.cache_key())
+
+    def is_valid_year_range(self):
+        """
+        Check if both ends of the task's range of years are integers or open.
+        """
+        return all(year is None or (isinstance(year, int) and not isinstance(year, bool))
+                   for year in (self.year_start, self.year_end))
+
+    def stats_index(self):
+        """
+        Return the sums and counts the task reads: the aggregate index, or the
+        time index's view of the task's years.
+        """
+        if self.year_start is None and self.year_end is None:
+            return self.data_ingestor.index
+        return self.data_ingestor.time_index.between(self.year_start, self.year_end)
+
+    def value_distributions(self):
+        """
+        Return the value distributions the task reads, of the task's years only
+        if it has a range.
+        """
+        if self.year_start is None and self.year_end is None:
+            return self.data_ingestor.distributions
+        return self.data_ingestor.distributions.between(self.year_start, self.year_end)
+
+    def state_means(self):
+        """
+        Return the mean value of every state for the task's question.
+        """
+        state_stats = self.stats_index().state_stats(self.question)
+        return {state: mean_of(stats) for state, stats in state_stats.items()}
+
+    def global_mean(self):
+        """
+        Return the mean value of the task's question over all states.
+        """
+        return mean_of(self.stats_index().question_stats(self.question))
+
+class StateMeanTask(Task):
     """
     Task for calculating the mean value of a specific state.
     """
-    def __init__(self, question, state, data_frame):
-        self.question = question
-        self.state = state
-        self.data_frame = data_frame
+    priority = 0
+
+    def __init__(self, question, state, data_ingestor):
+        super().__init__(question, data_ingestor, state)
+
+    def estimated_cost(self):
+        """
+        The task reads a single state's entry.
+        """
+        return 1
 
     def execute(self):
         """
         Execute method for StateMeanTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
         if self.state is None:
             return {"status": "error", "message": "State not specified"}, 400
 
-        # Filter data to keep only records corresponding to the specified question and state
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question) &
-                                        (self.data_frame['LocationDesc'] == self.state)]
-        state_mean = relevant_data['Data_Value'].mean()
+        # Look up the sum and count of the records of the specified question and state
+        state_stats = self.stats_index().state_stats(self.question)
+        state_mean = mean_of(state_stats.get(self.state, (0.0, 0)))
 
         return {self.state: state_mean}
 
-class StatesMeanTask:
+class StatesMeanTask(Task):
     """
     Task for calculating the mean value of all states.
     """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
-
     def execute(self):
         """
         Execute method for StatesMeanTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question)]
-        state_means = {}
-        for state in relevant_data['LocationDesc'].unique():
-            state_data = relevant_data[relevant_data['LocationDesc'] == state]
-            state_means[state] = state_data['Data_Value'].mean()
-
-        sorted_results = sorted(state_means.items(), key=lambda x: x[1])
+        sorted_results = sorted(self.state_means().items(), key=lambda x: x[1])
 
-        result = {state: mean for state, mean in sorted_results}
+        return dict(sorted_results)
 
-        return result
-
-class Best5Task:
+class TopKTask(Task):
     """
-    Task for finding the best 5 states based on a specific question.
+    Task for ranking the k best or worst states based on a specific question,
+    optionally within a single stratification segment.
     """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
-
-    def execute(self):
+    def __init__(self, question, data_ingestor, k=5, direction='best', category=None,
+                 segment=None):
         """
-        Execute method for Best5Task.
+        Initialize the TopKTask instance.
+
+        Args:
+            question (str): The question the states are ranked on.
+            data_ingestor (DataIngestor): The dataset and its aggregate index.
+            k (int): Number of states in the ranking.
+            direction (str): 'best' or 'worst'.
+            category (str): StratificationCategory1 to rank within, e.g. 'Income'.
+            segment (str): Stratification1 to rank within, e.g. '$75,000 or greater'.
         """
-        # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
-            return {"status": "error", "message": "Invalid question"}, 400
-
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question)]
-        state_means = {}
-        for state in relevant_data['LocationDesc'].unique():
-            state_data = relevant_data[relevant_data['LocationDesc'] == state]
-            state_means[state] = state_data['Data_Value'].mean()
-
-        if self.question in webserver.data_ingestor.questions_best_is_min:
-            sorted_results = sorted(state_means.items(), key=lambda x: x[1])[:5]
-        else:
-            sorted_results = sorted(state_means.items(), key=lambda x: x[1], reverse=True)[:5]
-
-        result = {state: mean for state, mean in sorted_results}
-
-        return result
+        super().__init__(question, data_ingestor)
+        self.k = k
+        self.direction = direction
+        self.category = category
+        self.segment = segment
 
+    def cache_key(self):
+        """
+        Return a key made of the question and the ranking's parameters.
+        """
+        return (type(self).__name__, self.question, self.k, self.direction, self.category,
+                self.segment, self.year_start, self.year_end)
 
+    def ascending(self):
+        """
+        Check whether the ranking lists the lowest means first.
+        """
+        best_is_min = self.question in self.data_ingestor.questions_best_is_min
+        return best_is_min == (self.direction == 'best')
 
-class Worst5Task:
-    """
-    Task for finding the worst 5 states based on a specific question.
-    """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
+    def ranked_stats(self):
+        """
+        Return the {state: (sum, count)} mapping the states are ranked on.
+        """
+        if self.category is None:
+            return self.stats_index().state_stats(self.question)
+        segment_key = (self.category, self.segment)
+        return {state: segments[segment_key] for state, segments in
+                self.stats_index().category_stats(self.question).items()
+                if segment_key in segments}
 
     def execute(self):
         """
-        Execute method for Worst5Task.
+        Execute method for TopKTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question)]
+        if isinstance(self.k, bool) or not isinstance(self.k, int) or self.k < 1:
+            return {"status": "error", "message": "k must be a positive integer"}, 400
 
-        # Calculate the mean values for each state
-        state_means = {}
-        for state in relevant_data['LocationDesc'].unique():
-            state_data = relevant_data[relevant_data['LocationDesc'] == state]
-            state_means[state] = state_data['Data_Value'].mean()
+        if self.direction not in ('best', 'worst'):
+            return {"status": "error", "message": "direction must be 'best' or 'worst'"}, 400
 
-        # Sort the results based on mean
-        if self.question in webserver.data_ingestor.questions_best_is_max:
-            sorted_results = sorted(state_means.items(), key=lambda x: x[1])[:5]
-        else:
-            sorted_results = sorted(state_means.items(), key=lambda x: x[1], reverse=True)[:5]
+        if (self.category is None) != (self.segment is None):
+            return {"status": "error",
+                    "message": "stratification_category and stratification go together"}, 400
 
-        # Construct a JSON object with the results
-        result = {state: mean for state, mean in sorted_results}
+        # Mediile tuturor statelor, calculate vectorial; statele fără valori nu sunt clasate
+        stats = self.ranked_stats()
+        states = list(stats)
+        sums = np.fromiter((value_sum for value_sum, _ in stats.values()), float, len(states))
+        counts = np.fromiter((count for _, count in stats.values()), float, len(states))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        ranked = np.flatnonzero(counts > 0)
+        keys = means[ranked] if self.ascending() else -means[ranked]
+
+        return {states[i]: float(means[i]) for i in ranked[top_k(keys, self.k)]}
+
+class Best5Task(TopKTask):
+    """
+    Task for finding the best 5 states based on a specific question.
+    """
+    def __init__(self, question, data_ingestor):
+        super().__init__(question, data_ingestor, k=5, direction='best')
 
-        return result
+class Worst5Task(TopKTask):
+    """
+    Task for finding the worst 5 states based on a specific question.
+    """
+    def __init__(self, question, data_ingestor):
+        super().__init__(question, data_ingestor, k=5, direction='worst')
 
-class GlobalMeanTask:
+class GlobalMeanTask(Task):
     """
     Task for calculating the global mean value of a specific question.
     """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
+    priority = 0
 
     def execute(self):
         """
         Execute method for GlobalMeanTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question)]
+        return {"global_mean": self.global_mean()}
 
-        # Calculate the mean value
-        global_mean = relevant_data['Data_Value'].mean()
-
-        return {"global_mean": global_mean}
-
-class DiffFromMeanTask:
+class DiffFromMeanTask(Task):
     """
     Task for calculating the difference between the global mean and state means.
     """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
-
     def execute(self):
         """
         Execute method for DiffFromMeanTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[self.data_frame['Question'] == self.question]
-
-        # Calculate the mean values for each state
-        state_means = {}
-        for state in relevant_data['LocationDesc'].unique():
-            state_data = relevant_data[relevant_data['LocationDesc'] == state]
-            state_means[state] = state_data['Data_Value'].mean()
-
-        # Calculate the global mean of the recorded values
-        global_mean = relevant_data['Data_Value'].mean()
+        global_mean = self.global_mean()
 
         # Calculate the difference between the global mean and the state mean for each state
-        diff_from_mean = {state: global_mean - mean for state, mean in state_means.items()}
+        diff_from_mean = {state: global_mean - mean for state, mean in self.state_means().items()}
 
         # Sort the differences in descending order
         sorted_diff_from_mean = sorted(diff_from_mean.items(), key=lambda x: x[1], reverse=True)
 
         # Construct a JSON object with the results
-        result = {state: mean for state, mean in sorted_diff_from_mean}
-
-        return result
+        return dict(sorted_diff_from_mean)
 
 
-class StateDiffFromMeanTask:
+class StateDiffFromMeanTask(Task):
     """
     Task for calculating the difference from the global mean for a specific state.
     """
-    def __init__(self, question, state, data_frame):
-        self.question = question
-        self.state = state
-        self.data_frame = data_frame
+    priority = 0
+
+    def __init__(self, question, state, data_ingestor):
+        super().__init__(question, data_ingestor, state)
+
+    def estimated_cost(self):
+        """
+        The task reads a single state's entry.
+        """
+        return 1
 
     def execute(self):
         """
         Execute method for StateDiffFromMeanTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Read data from the CSV file using DataIngestor
-        data_frame = webserver.data_ingestor.data
-
-        # Filter data to keep only records corresponding to the specified question and state
-        relevant_data = data_frame[(data_frame['Question'] == self.question) & \
-                                    (data_frame['LocationDesc'] == self.state)]
-        global_data = data_frame[data_frame['Question'] == self.question]
         # Check if there are no records for the specified state
-        if relevant_data.empty:
+        state_stats = self.stats_index().state_stats(self.question)
+        if self.state not in state_stats:
             return {"status": "error", "message": f"No data available for {self.state}"}, 400
 
-        # Calculate the mean value for the specified state
-        state_mean = relevant_data['Data_Value'].mean()
-
-        # Calculate the global mean of the recorded values
-        global_mean = global_data['Data_Value'].mean()
-
         # Calculate the difference between the global mean and the mean for the specified state
-        diff_from_mean = global_mean - state_mean
+        diff_from_mean = self.global_mean() - mean_of(state_stats[self.state])
 
         return {self.state: diff_from_mean}
 
-class MeanByCategoryTask:
+class MeanByCategoryTask(Task):
     """
     Task for calculating the mean value by category for a specific question.
     """
-    def __init__(self, question, data_frame):
-        self.question = question
-        self.data_frame = data_frame
+    priority = 2
+
+    def estimated_cost(self):
+        """
+        The task reads every category segment of every state.
+        """
+        return sum(len(segments) for segments in
+                   self.data_ingestor.index.category_stats(self.question).values())
 
     def execute(self):
         """
         Execute method for MeanByCategoryTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question)]
+        category_stats = self.stats_index().category_stats(self.question)
 
-        # Calculate the mean value for each segment within the categories of each state
-        mean_by_category = relevant_data.groupby(['LocationDesc', 'StratificationCategory1', 'Stratification1'])['Data_Value'].mean()
-
-        # Transform the results into an easy-to-use format
-        results = {f"('{state}', '{category}', '{segment}')": mean_value for (state, category, segment), mean_value in mean_by_category.items()}
+        # Transform the results into an easy-to-use format, ordered like a groupby
+        results = {}
+        for state in sorted(category_stats):
+            for category, segment in sorted(category_stats[state]):
+                stats = category_stats[state][(category, segment)]
+                results[f"('{state}', '{category}', '{segment}')"] = mean_of(stats)
 
         return results
 
-class StateMeanByCategoryTask:
+class StateMeanByCategoryTask(Task):
     """
     Task for calculating the mean value by category for a specific state and question.
     """
-    def __init__(self, question, state, data_frame):
-        self.question = question
-        self.state = state
-        self.data_frame = data_frame
+    priority = 0
+
+    def __init__(self, question, state, data_ingestor):
+        super().__init__(question, data_ingestor, state)
+
+    def estimated_cost(self):
+        """
+        The task reads every category segment of one state.
+        """
+        return len(self.data_ingestor.index.category_stats(self.question).get(self.state, {}))
 
     def execute(self):
         """
         Execute method for StateMeanByCategoryTask.
         """
         # Check if the question is valid
-        if self.question not in webserver.data_ingestor.questions_best_is_min and \
-           self.question not in webserver.data_ingestor.questions_best_is_max:
+        if not self.is_valid_question():
             return {"status": "error", "message": "Invalid question"}, 400
 
-        # Filter data to keep only records corresponding to the specified question and state
-        relevant_data = self.data_frame[(self.data_frame['Question'] == self.question) & \
-            (self.data_frame['LocationDesc'] == self.state)]
-
-        # Calculate the mean value for each segment within the respective categories
-        mean_by_category = relevant_data.groupby(['StratificationCategory1', 'Stratification1'])['Data_Value'].mean()
+        category_stats = self.stats_index().category_stats(self.question).get(self.state, {})
 
         # Transform the results into an easy-to-use format
-        results = {f"('{category}', '{segment}')": mean_value for (category, segment), mean_value in mean_by_category.items()}
+        results = {f"('{category}', '{segment}')": mean_of(category_stats[(category, segment)])
+                   for category, segment in sorted(category_stats)}
 
         return {self.state: results}
+
+# Quantiles answered when a request doesn't list any
+DEFAULT_QUANTILES = [0.25, 0.5, 0.75]
+
+class QuantilesTask(Task):
+    """
+    Base class for the tasks answering quantiles of a question's values.
+    """
+    def __init__(self, question, data_ingestor, state=None, quantiles=None):
+        super().__init__(question, data_ingestor, state)
+        self.quantiles = DEFAULT_QUANTILES if quantiles is None else quantiles
+
+    def cache_key(self):
+        """
+        Return a key made of the question, the state and the quantiles.
+        """
+        quantiles = tuple(self.quantiles) if isinstance(self.quantiles, list) else self.quantiles
+        return super().cache_key() + (quantiles,)
+
+    def are_valid_quantiles(self):
+        """
+        Check if the task's quantiles are a non-empty list of numbers in [0, 1].
+        """
+        return isinstance(self.quantiles, list) and len(self.quantiles) > 0 and all(
+            isinstance(q, (int, float)) and not isinstance(q, bool) and 0 <= q <= 1
+            for q in self.quantiles)
+
+    def validate(self):
+        """
+        Return the error answer for an invalid question or quantiles, or None.
+        """
+        if not self.is_valid_question():
+            return {"status": "error", "message": "Invalid question"}, 400
+        if not self.are_valid_quantiles():
+            return {"status": "error",
+                    "message": "quantiles must be a list of numbers between 0 and 1"}, 400
+        return None
+
+    def quantiles_of(self, distribution):
+        """
+        Return the task's quantiles of a distribution, by quantile.
+        """
+        return {str(q): distribution.quantile(q) for q in self.quantiles}
+
+class StatesQuantilesTask(QuantilesTask):
+    """
+    Task for calculating quantiles of the values of every state.
+    """
+    def execute(self):
+        """
+        Execute method for StatesQuantilesTask.
+        """
+        error = self.validate()
+        if error is not None:
+            return error
+
+        distributions = self.value_distributions().state_distributions(self.question)
+        return {state: self.quantiles_of(distributions[state]) for state in sorted(distributions)}
+
+class StateQuantilesTask(QuantilesTask):
+    """
+    Task for calculating quantiles of the values of a specific state.
+    """
+    priority = 0
+
+    def __init__(self, question, state, data_ingestor, quantiles=None):
+        super().__init__(question, data_ingestor, state, quantiles)
+
+    def estimated_cost(self):
+        """
+        The task reads a single state's entry.
+        """
+        return 1
+
+    def execute(self):
+        """
+        Execute method for StateQuantilesTask.
+        """
+        error = self.validate()
+        if error is not None:
+            return error
+
+        if self.state is None:
+            return {"status": "error", "message": "State not specified"}, 400
+
+        distribution = self.value_distributions().state_distributions(self.question) \
+            .get(self.state, EMPTY_DISTRIBUTION)
+        return {self.state: self.quantiles_of(distribution)}
+
+class GlobalQuantilesTask(QuantilesTask):
+    """
+    Task for calculating quantiles of the values of a question over all states.
+    """
+    priority = 0
+
+    def estimated_cost(self):
+        """
+        The task reads the question's entry.
+        """
+        return 1
+
+    def execute(self):
+        """
+        Execute method for GlobalQuantilesTask.
+        """
+        error = self.validate()
+        if error is not None:
+            return error
+
+        distribution = self.value_distributions().question_distribution(self.question)
+        return {"global_quantiles": self.quantiles_of(distribution)}
+
+class StatesStddevTask(Task):
+    """
+    Task for calculating the standard deviation of the values of every state.
+    """
+    def execute(self):
+        """
+        Execute method for StatesStddevTask.
+        """
+        # Check if the question is valid
+        if not self.is_valid_question():
+            return {"status": "error", "message": "Invalid question"}, 400
+
+        distributions = self.value_distributions().state_distributions(self.question)
+        return {state: distributions[state].stddev() for state in sorted(distributions)}
+
+class StateStddevTask(Task):
+    """
+    Task for calculating the standard deviation of the values of a specific state.
+    """
+    priority = 0
+
+    def __init__(self, question, state, data_ingestor):
+        super().__init__(question, data_ingestor, state)
+
+    def estimated_cost(self):
+        """
+        The task reads a single state's entry.
+        """
+        return 1
+
+    def execute(self):
+        """
+        Execute method for StateStddevTask.
+        """
+        # Check if the question is valid
+        if not self.is_valid_question():
+            return {"status": "error", "message": "Invalid question"}, 400
+
+        if self.state is None:
+            return {"status": "error", "message": "State not specified"}, 400
+
+        distribution = self.value_distributions().state_distributions(self.question) \
+            .get(self.state, EMPTY_DISTRIBUTION)
+        return {self.state: distribution.stddev()}
+
+class GlobalStddevTask(Task):
+    """
+    Task for calculating the standard deviation of a question's values over all states.
+    """
+    priority = 0
+
+    def estimated_cost(self):
+        """
+        The task reads the question's entry.
+        """
+        return 1
+
+    def execute(self):
+        """
+        Execute method for GlobalStddevTask.
+        """
+        # Check if the question is valid
+        if not self.is_valid_question():
+            return {"status": "error", "message": "Invalid question"}, 400
+
+        distribution = self.value_distributions().question_distribution(self.question)
+        return {"global_stddev": distribution.stddev()}
+
+# Task classes by the name of the endpoint that submits them
+TASKS_BY_ENDPOINT = {
+    'states_mean': StatesMeanTask,
+    'state_mean': StateMeanTask,
+    'best5': Best5Task,
+    'worst5': Worst5Task,
+    'topk': TopKTask,
+    'states_quantiles': StatesQuantilesTask,
+    'state_quantiles': StateQuantilesTask,
+    'global_quantiles': GlobalQuantilesTask,
+    'states_stddev': StatesStddevTask,
+    'state_stddev': StateStddevTask,
+    'global_stddev': GlobalStddevTask,
+    'global_mean': GlobalMeanTask,
+    'diff_from_mean': DiffFromMeanTask,
+    'state_diff_from_mean': StateDiffFromMeanTask,
+    'mean_by_category': MeanByCategoryTask,
+    'state_mean_by_category': StateMeanByCategoryTask,
+}
+
+# Endpoints whose tasks also take a state
+STATE_ENDPOINTS = {'state_mean', 'state_diff_from_mean', 'state_mean_by_category',
+                   'state_quantiles', 'state_stddev'}
+
+def top_k(keys, k):
+    """
+    Return the positions of the k smallest keys in ascending order, ties broken by
+    position like a stable sort would, after a partial selection that only sorts
+    those k.
+    """
+    if k >= len(keys):
+        return np.argsort(keys, kind='stable')
+    threshold = np.partition(keys, k - 1)[k - 1]
+    below = np.flatnonzero(keys < threshold)
+    tied = np.flatnonzero(keys == threshold)[:k - len(below)]
+    selected = np.concatenate((below, tied))
+    return selected[np.argsort(keys[selected], kind='stable')]
+
+def is_plain_key(key):
+    """
+    Check if a key is None, a string, a number or a tuple of such keys.
+    """
+    if isinstance(key, tuple):
+        return all(is_plain_key(item) for item in key)
+    return key is None or isinstance(key, (str, int, float))
+
+def create_task(endpoint, query, data_ingestor):
+    """
+    Create the task an analytic endpoint would submit for a request body.
+    """
+    task_class = TASKS_BY_ENDPOINT[endpoint]
+    if task_class is TopKTask:
+        task = TopKTask(query.get('question'), data_ingestor, query.get('k', 5),
+                        query.get('direction', 'best'), query.get('stratification_category'),
+                        query.get('stratification'))
+    elif issubclass(task_class, QuantilesTask) and endpoint in STATE_ENDPOINTS:
+        task = task_class(query.get('question'), query.get('state'), data_ingestor,
+                          quantiles=query.get('quantiles'))
+    elif issubclass(task_class, QuantilesTask):
+        task = task_class(query.get('question'), data_ingestor, quantiles=query.get('quantiles'))
+    elif endpoint in STATE_ENDPOINTS:
+        task = task_class(query.get('question'), query.get('state'), data_ingestor)
+    else:
+        task = task_class(query.get('question'), data_ingestor)
+
+    task.year_start = query.get('year_start')
+    task.year_end = query.get('year_end')
+    return task
+
+class BatchTask(Task):
+    """
+    Task for answering a list of analytic queries in a single job.
+
+    The task of every query is created once, with the batch, and reused to key,
+    check, cost and answer it.
+    """
+    priority = 2
+
+    def __init__(self, queries, data_ingestor):
+        super().__init__(None, data_ingestor)
+        self.tasks = [create_task(query['endpoint'], query, data_ingestor) for query in queries]
+
+    def cache_key(self):
+        """
+        Return a key made of the parameters of every query in the batch.
+        """
+        return (type(self).__name__,) + tuple(task.cache_key() for task in self.tasks)
+
+    def is_valid_year_range(self):
+        """
+        Check the range of years of every query in the batch.
+        """
+        return all(task.is_valid_year_range() for task in self.tasks)
+
+    def estimated_cost(self):
+        """
+        The batch costs as much as all of its queries.
+        """
+        return sum(task.estimated_cost() for task in self.tasks)
+
+    def execute(self):
+        """
+        Execute method for BatchTask.
+        """
+        # Every query is answered from the same aggregate index, in the requested order
+        results = []
+        for task in self.tasks:
+            # A batch sent to a worker process arrives with the worker's dataset only
+            task.data_ingestor = self.data_ingestor
+            result = task.execute()
+
+            # Errors are reported per query, without their HTTP status code
+            if isinstance(result, tuple):
+                result = result[0]
+            results.append(result)
+
+        return results
@@ -1,41 +1,197 @@
-import json
-from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import os
+import time
 import multiprocessing
+from app.result_cache import ResultCache
+from app.job_store import JobStore
+from app.sqlite_job_store import SqliteJobStore
+from app.result_log import ResultLog
+from app.process_backend import ProcessBackend
+from app.scheduler import FairScheduler, SchedulerFull
+from app.metrics import METRICS
 
 class ThreadPool:
     """
     A class representing a thread pool for executing tasks asynchronously.
     """
-    def __init__(self):
+    def __init__(self, data_ingestor=None):
         """
         Initialize the ThreadPool instance.
+
+        Args:
+            data_ingestor (DataIngestor): The dataset, needed when TP_EXECUTOR is
+                'process' so it can be shared with the worker processes.
         """
-        self.dictionary = {}
         # Determine the number of threads allowed by hardware
         self.num_threads = int(os.environ.get('TP_NUM_OF_THREADS', multiprocessing.cpu_count()))
 
-        # Initialize a task queue
-        self.task_queue = Queue()
-        self.job_id = 0
+        # With TP_EXECUTOR=process the threads hand each task to a pool of as many
+        # worker processes, so the computation isn't bound by the GIL
+        self.process_backend = None
+        if os.environ.get('TP_EXECUTOR', 'thread') == 'process':
+            self.process_backend = ProcessBackend(data_ingestor, self.num_threads)
+
+        # Initialize a bounded task queue that schedules the priority classes of the
+        # tasks by weighted round robin and the clients within a class fairly
+        self.task_queue = FairScheduler(
+            weights=[int(weight) for weight in
+                     os.environ.get('SCHEDULER_WEIGHTS', '4,2,1').split(',')],
+            max_queued=int(os.environ.get('SCHEDULER_MAX_QUEUED', 10000)),
+            max_per_client=int(os.environ.get('SCHEDULER_MAX_PER_CLIENT', 1000)),
+            retry_after=int(os.environ.get('SCHEDULER_RETRY_AFTER', 1)))
+
+        # Finished jobs are evicted after JOB_STORE_TTL seconds or beyond
+        # JOB_STORE_MAX_ENTRIES jobs; an empty value disables either limit.
+        # With JOB_STORE_BACKEND=sqlite the jobs are kept in the JOB_STORE_PATH
+        # database, shared by every server process using it, and jobs still
+        # running after JOB_STORE_RUNNING_TTL seconds, whose process may have died,
+        # are failed
+        ttl = os.environ.get('JOB_STORE_TTL', 3600)
+        ttl = float(ttl) if ttl else None
+        max_entries = os.environ.get('JOB_STORE_MAX_ENTRIES', 100000)
+        max_entries = int(max_entries) if max_entries else None
+        if os.environ.get('JOB_STORE_BACKEND', 'memory') == 'sqlite':
+            running_ttl = os.environ.get('JOB_STORE_RUNNING_TTL', 600)
+            self.job_store = SqliteJobStore(os.environ.get('JOB_STORE_PATH', './jobs.sqlite3'),
+                                            ttl, max_entries,
+                                            running_ttl=float(running_ttl) if running_ttl else None)
+        else:
+            self.job_store = JobStore(int(os.environ.get('JOB_STORE_SHARDS', 16)),
+                                      ttl, max_entries)
+
+        # Results of identical tasks are served from a cache shared by all threads
+        self.result_cache = ResultCache(
+            int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1024)),
+            int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+        # Results are appended to segment files in ./results by a single writer thread
+        self.result_log = ResultLog(
+            os.environ.get('RESULT_LOG_DIR', './results'),
+            segment_bytes=int(os.environ.get('RESULT_LOG_SEGMENT_BYTES', 64 * 1024 * 1024)),
+            max_segments=int(os.environ.get('RESULT_LOG_MAX_SEGMENTS', 16)),
+            fsync_policy=os.environ.get('RESULT_LOG_FSYNC', 'interval'),
+            fsync_interval=float(os.environ.get('RESULT_LOG_FSYNC_INTERVAL', 1.0)))
+
+        # Tasks touching at most this many index entries may be answered inline
+        self.sync_cost_threshold = int(os.environ.get('SYNC_COST_THRESHOLD', 1000))
+
+        # Jobs attached to an identical queued or running job, keyed on the task's
+        # cache key and dataset version
+        self.inflight = {}
+        self.inflight_lock = Lock()
+        self.coalesced_jobs = 0
+
         # Initialize threads within the pool
-        self.threads = [TaskRunner(self.task_queue, self.dictionary) for _ in range(self.num_threads)]
+        self.threads = [TaskRunner(self) for _ in range(self.num_threads)]
 
-    def add_task(self, task):
+    def add_task(self, task, client=None):
         """
         Add a task to the task queue.
+
+        If an identical task is already queued or running, the new job is attached
+        to it instead and receives the same result when it finishes.
+
+        Args:
+            task (Task): The task to execute.
+            client (str): Who submitted the task, for fair queueing.
+
+        Raises:
+            SchedulerFull: The queue has no room for the task.
+        """
+        # The key is kept on the task, since the version may change before it is
+        # done; it is computed first, so a task whose key fails leaves no job behind
+        key = task.inflight_key = (task.data_ingestor.version,) + task.cache_key()
+        hash(key)
+
+        # The job is visible as running as soon as its id is returned
+        job_id = self.job_store.create()
+        with self.inflight_lock:
+            followers = self.inflight.get(key)
+            if followers is not None:
+                followers.append(job_id)
+                self.coalesced_jobs += 1
+                return job_id
+            self.inflight[key] = []
+
+        # Add a task to the queue, or give up on the job if it is refused
+        try:
+            self.task_queue.put((task, job_id), task.priority, client)
+        except SchedulerFull as error:
+            # Jobs that attached in the meantime fail along with this one
+            for follower_id in self.take_followers(task):
+                self.job_store.finish(follower_id,
+                                      ({"status": "error", "message": str(error)}, 429))
+            self.job_store.discard(job_id)
+            raise
+        return job_id
+
+    def try_execute_inline(self, task):
+        """
+        Answer a task on the calling thread, provided its result is cached or its
+        estimated cost is under SYNC_COST_THRESHOLD.
+
+        Returns:
+            tuple: (True, result) if the task was answered, (False, None) if it
+                should be queued instead.
+        """
+        key = task.cache_key()
+        version = task.data_ingestor.version
+        if not self.result_cache.contains(key, version) and \
+           task.estimated_cost() > self.sync_cost_threshold:
+            return False, None
+
+        cached, value = self.result_cache.get(key, version)
+        if not cached:
+            value = task.execute()
+            self.result_cache.put(key, version, value)
+        return True, value
+
+    def take_followers(self, task):
+        """
+        Return the ids of the jobs attached to a task, which stops accepting new ones.
+        """
+        with self.inflight_lock:
+            return self.inflight.pop(task.inflight_key, [])
+
+    def num_pending(self):
+        """
+        Return the number of jobs waiting to be done: those queued in this
+        process, or those of every process when the job store is shared.
         """
-        self.job_id += 1
-        # Add a task to the queue
-        self.task_queue.put((task, self.job_id))
-        return self.job_id
+        if self.job_store.shared:
+            return self.job_store.count_running()
+        return self.task_queue.qsize()
+
+    def collect_metrics(self):
+        """
+        Return the pool's scrape-time metrics, in the format of Metrics.render().
+        """
+        cache_stats = self.result_cache.stats()
+        now = time.monotonic()
+        busy = [((('worker', thread.name),), thread.busy_seconds) for thread in self.threads]
+        idle = [((('worker', thread.name),), max(now - thread.started_at - thread.busy_seconds, 0))
+                for thread in self.threads if thread.started_at is not None]
+        return [
+            ("webserver_queue_jobs", "gauge", [((), self.task_queue.qsize())]),
+            ("webserver_job_store_jobs", "gauge", [((), len(self.job_store))]),
+            ("webserver_job_store_evictions_total", "counter", [((), self.job_store.evictions)]),
+            ("webserver_coalesced_jobs_total", "counter", [((), self.coalesced_jobs)]),
+            ("webserver_result_cache_entries", "gauge", [((), cache_stats["entries"])]),
+            ("webserver_result_cache_bytes", "gauge", [((), cache_stats["bytes"])]),
+            ("webserver_result_cache_hits_total", "counter", [((), cache_stats["hits"])]),
+            ("webserver_result_cache_misses_total", "counter", [((), cache_stats["misses"])]),
+            ("webserver_result_cache_evictions_total", "counter",
+             [((), cache_stats["evictions"])]),
+            ("webserver_worker_busy_seconds_total", "counter", busy),
+            ("webserver_worker_idle_seconds_total", "counter", idle),
+        ]
 
     def start(self):
         """
         Start each thread in the pool.
         """
         # Start each thread
+        self.result_log.start()
         for thread in self.threads:
             thread.start()
 
@@ -46,32 +202,54 @@ class ThreadPool:
         # Notify each thread to stop
         for thread in self.threads:
             thread.stop()
+        self.result_log.stop()
+        if self.process_backend is not None:
+            self.process_backend.shutdown()
 
 class TaskRunner(Thread):
     """
     A class representing a thread responsible for executing tasks.
     """
-    def __init__(self, task_queue, dictionary):
+    def __init__(self, thread_pool):
         """
         Initialize the TaskRunner instance.
+
+        Args:
+            thread_pool (ThreadPool): The pool whose queue, job store, result cache
+                and result log the thread works with.
         """
         super().__init__()
-        self.task_queue = task_queue
+        self.thread_pool = thread_pool
+        self.task_queue = thread_pool.task_queue
         self.graceful_shutdown = Event()
-        self.dictionary = dictionary
+        self.job_store = thread_pool.job_store
+        self.result_cache = thread_pool.result_cache
+        self.result_log = thread_pool.result_log
+        self.process_backend = thread_pool.process_backend
+
+        # Time spent executing tasks, read by the metrics scrape
+        self.started_at = None
+        self.busy_seconds = 0.0
 
     def run(self):
         """
         Execute tasks from the task queue.
         """
-        
+        self.started_at = time.monotonic()
         while not self.graceful_shutdown.is_set():
             try:
                 # Wait for a task from the queue or timeout after 1 second
-                task, job_id = self.task_queue.get()
+                (task, job_id), queue_wait = self.task_queue.get(timeout=1)
+                self.job_store.start(job_id, queue_wait)
+                labels = (('task', type(task).__name__),)
+                METRICS.observe("webserver_queue_wait_seconds", labels, queue_wait)
 
                 # Execute the task and save the result to disk
+                started = time.monotonic()
                 self.execute_task(task, job_id)
+                elapsed = time.monotonic() - started
+                self.busy_seconds += elapsed
+                METRICS.observe("webserver_execute_seconds", labels, elapsed)
 
             except Exception:
                 # If an exception occurs, continue execution
@@ -80,24 +258,36 @@ class TaskRunner(Thread):
 
     def execute_task(self, task, job_id):
         """
-        Execute a task and save the result.
+        Execute a task and save the result, for its job and the jobs attached to it.
         """
-        self.dictionary[job_id] = {"status": "running", "result": None}
-        value = task.execute()
-        self.dictionary[job_id] = {"status": "done", "result": value}
-        # Process the data or perform necessary operations
-        self.save_result(job_id, value)
+        # Reuse the result of an identical task computed on the same dataset version
+        key = task.cache_key()
+        version = task.data_ingestor.version
+        cached, value = self.result_cache.get(key, version)
+        if not cached:
+            try:
+                # The workers only know the rows shared with them at startup
+                if self.process_backend is not None and self.process_backend.version == version:
+                    value = self.process_backend.execute(task)
+                else:
+                    value = task.execute()
+                self.result_cache.put(key, version, value)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                # The attached jobs must not wait forever on a failed task
+                value = {"status": "error", "message": str(error)}, 500
+
+        # Errors, which carry their status code, are never served as not modified
+        etag = None if isinstance(value, tuple) else task.etag(version)
+        for finished_id in [job_id] + self.thread_pool.take_followers(task):
+            self.job_store.finish(finished_id, value, etag)
+            # Process the data or perform necessary operations
+            self.save_result(finished_id, value)
 
     def save_result(self, job_id, result):
         """
-        Save the result to a JSON file.
+        Hand the result to the result log, which writes it in the background.
         """
-        # Define the path to the file where the results will be saved
-        file_path = f"./results/{job_id}.json"
-
-        # Create a JSON file and write the results to it
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(result, file)
+        self.result_log.append(job_id, result)
 
     def stop(self):
         """
@@ -0,0 +1,176 @@
+"""
+Per-year aggregates over the nutrition dataset, for queries on a range of years.
+"""
+from functools import partial
+import numpy as np
+from app.aggregate_index import VALUE_COLUMN, STATE_KEYS, CATEGORY_KEYS
+
+YEAR_COLUMN = 'YearStart'
+
+
+class TimeIndex:
+    """
+    Sums and counts of Data_Value per year, per question, per (question, state)
+    and per (question, state, StratificationCategory1, Stratification1), bucketed
+    by YearStart.
+
+    Every entry is an array of prefix sums over the sorted years, one (sum, count)
+    row per year plus a leading row of zeros, so the totals of any range of years
+    are the difference of two rows, whatever the number of rows in the dataset.
+
+    The years and the mappings are swapped in together, as one tuple, after an
+    update built them on copies, so readers always see entries laid out for the
+    years they read. Updates must not run concurrently.
+    """
+    def __init__(self):
+        # (years, {question: prefix}, {question: {state: prefix}},
+        #  {question: {state: {(category, segment): prefix}}})
+        self.tables = (np.empty(0, dtype=np.int64), {}, {}, {})
+
+    def update(self, data_frame):
+        """
+        Fold the rows of a DataFrame into the index.
+
+        Args:
+            data_frame (pd.DataFrame): Rows with at least the columns used as keys,
+                YearStart and Data_Value.
+        """
+        years, questions, states, categories = self.tables
+        new_years = np.union1d(years, data_frame[YEAR_COLUMN].unique()).astype(np.int64)
+        if len(new_years) != len(years):
+            # Entries are laid out per year, so they all move to the new layout
+            relayout = partial(_relayout, positions=np.searchsorted(new_years, years),
+                               num_years=len(new_years))
+            questions = _map_nested(questions, 1, relayout)
+            states = _map_nested(states, 2, relayout)
+            categories = _map_nested(categories, 3, relayout)
+        else:
+            questions, states, categories = dict(questions), dict(states), dict(categories)
+
+        for (question,), added in _year_prefixes(data_frame, ['Question'], new_years).items():
+            questions[question] = _add(questions.get(question), added)
+
+        copied = set()
+        for (question, state), added in _year_prefixes(data_frame, STATE_KEYS, new_years).items():
+            if question not in copied:
+                states[question] = dict(states.get(question, {}))
+                copied.add(question)
+            states[question][state] = _add(states[question].get(state), added)
+
+        copied = set()
+        for (question, state, category, segment), added in \
+                _year_prefixes(data_frame, CATEGORY_KEYS, new_years).items():
+            if question not in copied:
+                categories[question] = dict(categories.get(question, {}))
+                copied.add(question)
+            if (question, state) not in copied:
+                categories[question][state] = dict(categories[question].get(state, {}))
+                copied.add((question, state))
+            segments = categories[question][state]
+            segments[(category, segment)] = _add(segments.get((category, segment)), added)
+
+        self.tables = (new_years, questions, states, categories)
+
+    def between(self, year_start=None, year_end=None):
+        """
+        Return the aggregates of the years from year_start to year_end, both
+        included; None leaves that end of the range open.
+
+        Returns:
+            YearRange: A view with the lookup methods of AggregateIndex.
+        """
+        return YearRange(self.tables, year_start, year_end)
+
+
+class YearRange:
+    """
+    The aggregates of a range of years, looked up like those of an AggregateIndex.
+
+    Only the keys with values in the range are listed, so a state without values
+    in those years is left out rather than given a NaN mean.
+    """
+    def __init__(self, tables, year_start, year_end):
+        self.tables = tables
+        years = tables[0]
+        self.lower = 0 if year_start is None else int(np.searchsorted(years, year_start, 'left'))
+        self.upper = len(years) if year_end is None else \
+            int(np.searchsorted(years, year_end, 'right'))
+
+    def _stats(self, prefix):
+        if self.upper <= self.lower:
+            return (0.0, 0)
+        value_sum, count = prefix[self.upper] - prefix[self.lower]
+        return (float(value_sum), int(round(count)))
+
+    def _present(self, prefixes):
+        stats = {key: self._stats(prefix) for key, prefix in prefixes.items()}
+        return {key: pair for key, pair in stats.items() if pair[1] > 0}
+
+    def question_stats(self, question):
+        """
+        Return the (sum, count) pair of a question in the range.
+        """
+        prefix = self.tables[1].get(question)
+        return (0.0, 0) if prefix is None else self._stats(prefix)
+
+    def state_stats(self, question):
+        """
+        Return a {state: (sum, count)} mapping for a question in the range.
+        """
+        return self._present(self.tables[2].get(question, {}))
+
+    def category_stats(self, question):
+        """
+        Return a {state: {(category, segment): (sum, count)}} mapping for a
+        question in the range.
+        """
+        results = {}
+        for state, segments in self.tables[3].get(question, {}).items():
+            present = self._present(segments)
+            if present:
+                results[state] = present
+        return results
+
+
+def _year_prefixes(data_frame, keys, years):
+    """
+    Group the rows on keys and return the per-year prefix sums of each group.
+    """
+    grouped = data_frame.groupby(keys + [YEAR_COLUMN], observed=True)[VALUE_COLUMN] \
+        .agg(['sum', 'count'])
+    row_keys = list(zip(*(grouped.index.get_level_values(level) for level in range(len(keys)))))
+    group_keys = list(dict.fromkeys(row_keys))
+    key_positions = {key: position for position, key in enumerate(group_keys)}
+    rows = [key_positions[key] for key in row_keys]
+
+    # One (years + 1, 2) block of prefix sums per group, computed all at once
+    prefixes = np.zeros((len(group_keys), len(years) + 1, 2))
+    year_positions = np.searchsorted(years, grouped.index.get_level_values(-1)) + 1
+    prefixes[rows, year_positions] = grouped[['sum', 'count']].to_numpy(dtype=float)
+    np.cumsum(prefixes, axis=1, out=prefixes)
+    return dict(zip(group_keys, prefixes))
+
+
+def _add(prefix, added):
+    """
+    Add prefix sums to those of an entry, or start the entry with them.
+    """
+    return added if prefix is None else prefix + added
+
+
+def _relayout(prefix, positions, num_years):
+    """
+    Move an entry's prefix sums to a layout with more years.
+    """
+    per_year = np.zeros((num_years, 2))
+    per_year[positions] = np.diff(prefix, axis=0)
+    return np.vstack((np.zeros((1, 2)), np.cumsum(per_year, axis=0)))
+
+
+def _map_nested(mapping, depth, function):
+    """
+    Apply a function to the leaves of nested dictionaries, returning copies.
+    """
+    if depth == 0:
+        return function(mapping)
+    return {key: _map_nested(value, depth - 1, function) for key, value in mapping.items()}
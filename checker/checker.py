@@ -1,9 +1,12 @@
 import requests
 import json
+import math
 import unittest
+import importlib.util
 
 from datetime import datetime, timedelta
 from time import sleep
+from threading import Thread
 import os
 
 import sys
@@ -87,6 +90,102 @@ class TestAPI(unittest.TestCase):
     def test_state_mean_by_category(self):
         self.helper_test_endpoint("state_mean_by_category")
 
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_topk(self):
+        self.helper_test_endpoint("topk")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_topk_segments(self):
+        input_dir = "tests/topk/input/"
+        for input_file in os.listdir(input_dir):
+            with open(f"{input_dir}/{input_file}", "r") as fin:
+                req_data = json.load(fin)
+            if "stratification_category" not in req_data or "stratification" not in req_data:
+                continue
+
+            with self.subTest(input_file=input_file):
+                # A state ranked within a segment has the mean mean_by_category gives it
+                ranking = self.helper_get_result("topk", req_data)
+                means = self.helper_get_result(
+                    "mean_by_category", {name: value for name, value in req_data.items()
+                                         if name in ("question", "year_start", "year_end")})
+                segment = (req_data["stratification_category"], req_data["stratification"])
+                self.assertTrue(ranking)
+                for state, mean in ranking.items():
+                    self.assertAlmostEqual(mean, means[str((state,) + segment)], delta=0.01)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_states_quantiles(self):
+        self.helper_test_endpoint("states_quantiles")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_state_quantiles(self):
+        self.helper_test_endpoint("state_quantiles")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_global_quantiles(self):
+        self.helper_test_endpoint("global_quantiles")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_states_stddev(self):
+        self.helper_test_endpoint("states_stddev")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_state_stddev(self):
+        self.helper_test_endpoint("state_stddev")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_global_stddev(self):
+        self.helper_test_endpoint("global_stddev")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_quantile_bounds(self):
+        input_dir = "tests/states_mean/input/"
+        for input_file in os.listdir(input_dir):
+            with open(f"{input_dir}/{input_file}", "r") as fin:
+                question = json.load(fin)["question"]
+
+            # Within a single year a state has fewer values, possibly a single one
+            for years in ({}, {"year_start": 2020, "year_end": 2020}):
+                with self.subTest(question=question, years=years):
+                    means = self.helper_get_result("states_mean", dict(years, question=question))
+                    bounds = self.helper_get_result(
+                        "states_quantiles", dict(years, question=question, quantiles=[0, 1]))
+                    stddevs = self.helper_get_result("states_stddev",
+                                                     dict(years, question=question))
+                    self.assertEqual(set(means), set(bounds))
+                    self.assertEqual(set(means), set(stddevs))
+
+                    # Quantiles 0 and 1 are the smallest and largest values, around the mean
+                    for state, mean in means.items():
+                        self.assertLessEqual(bounds[state]["0"], mean + 0.01)
+                        self.assertGreaterEqual(bounds[state]["1"], mean - 0.01)
+                        # Only a state with a single value has no standard deviation
+                        if math.isnan(stddevs[state]):
+                            self.assertAlmostEqual(bounds[state]["0"], mean, delta=0.01)
+                            self.assertAlmostEqual(bounds[state]["1"], mean, delta=0.01)
+                        else:
+                            self.assertGreaterEqual(stddevs[state], 0)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_batch(self):
+        self.helper_test_endpoint("batch")
+
+    def helper_get_result(self, endpoint, req_data, timeout_sec = 1, poll_interval = 0.05):
+        res = requests.post(f"http://127.0.0.1:5000/api/{endpoint}", json=req_data)
+        job_id = res.json()["job_id"]
+
+        initial_timestamp = datetime.now()
+        while True:
+            response = requests.get(f"http://127.0.0.1:5000/api/get_results/{job_id}")
+            self.assertEqual(response.status_code, 200)
+            response_data = response.json()
+            if response_data['status'] == 'done':
+                return response_data['data']
+            if (datetime.now() - initial_timestamp).seconds > timeout_sec:
+                self.fail("Operation timedout")
+            sleep(poll_interval)
+
     def helper_test_endpoint(self, endpoint):
         global total_score
 
@@ -158,6 +257,32 @@ class TestAPI(unittest.TestCase):
         if score < 8:
             total_score -= 5
 
+class TestMetrics(unittest.TestCase):
+    def load_metrics(self):
+        # Loaded from its file, so the server's package (and the dataset) isn't imported
+        spec = importlib.util.spec_from_file_location("metrics", "app/metrics.py")
+        metrics = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(metrics)
+        return metrics.Metrics()
+
+    def test_thread_storages_are_bounded(self):
+        metrics = self.load_metrics()
+
+        def record():
+            metrics.inc("requests_total", (("endpoint", "/api/states_mean"),))
+            metrics.observe("execute_seconds", (), 0.01)
+
+        for _ in range(1000):
+            thread = Thread(target=record)
+            thread.start()
+            thread.join()
+
+        # The storages of the exited threads are folded together, counts included
+        self.assertLessEqual(len(metrics.storages), 1)
+        rendered = metrics.render()
+        self.assertIn('requests_total{endpoint="/api/states_mean"} 1000', rendered)
+        self.assertIn('execute_seconds_count 1000', rendered)
+
 if __name__ == '__main__':
     try:
         unittest.main()
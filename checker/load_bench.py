@@ -0,0 +1,295 @@
+"""
+Concurrent load-replay benchmark for a running server.
+
+Replays the request bodies of tests/<endpoint>/input/*.json, and optionally a
+JSONL file of captured requests, against the server. Each request is submitted
+and then polled until done, and its end-to-end latency (submit to done) is
+recorded. The report has throughput, latency percentiles, poll counts and error
+rates. It is printed and can be written as JSON and compared against a baseline
+report.
+
+Closed loop, 8 clients for 30 s:
+    python checker/load_bench.py --concurrency 8 --duration 30 --output run.json
+
+Open loop, 200 requests/s, compared against an earlier run:
+    python checker/load_bench.py --rate 200 --duration 30 --baseline run.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def load_corpus(tests_dir, replay_file):
+    """
+    Return the (endpoint, body) pairs to replay.
+
+    Args:
+        tests_dir (str): Directory with one <endpoint>/input/*.json folder per endpoint.
+        replay_file (str): Optional JSONL file whose lines are request bodies with
+            an extra "endpoint" field.
+    """
+    corpus = []
+    if tests_dir:
+        for endpoint in sorted(os.listdir(tests_dir)):
+            input_dir = os.path.join(tests_dir, endpoint, "input")
+            if not os.path.isdir(input_dir):
+                continue
+            for name in sorted(os.listdir(input_dir)):
+                with open(os.path.join(input_dir, name), "r", encoding="utf-8") as fin:
+                    corpus.append((endpoint, json.load(fin)))
+
+    if replay_file:
+        with open(replay_file, "r", encoding="utf-8") as fin:
+            for line in fin:
+                if line.strip():
+                    body = json.loads(line)
+                    corpus.append((body.pop("endpoint"), body))
+    return corpus
+
+
+class LoadRunner:
+    """
+    Submits requests, polls them to completion and collects the samples.
+    """
+    def __init__(self, base_url, poll_interval, long_poll, timeout):
+        self.base_url = base_url
+        self.poll_interval = poll_interval
+        self.long_poll = long_poll
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def run_one(self, endpoint, body, started=None):
+        """
+        Submit one request and poll it until done, recording a sample.
+
+        Args:
+            started (float): When the request was due, for open-loop runs, so
+                that time spent waiting for a free client counts as latency.
+        """
+        started = time.monotonic() if started is None else started
+        sample = {"endpoint": endpoint, "polls": 0, "error": None}
+        session = self._session()
+        try:
+            response = session.post(f"{self.base_url}/api/{endpoint}", json=body,
+                                    timeout=self.timeout)
+            if response.status_code == 200:
+                # Answered synchronously
+                pass
+            elif response.status_code != 202:
+                sample["error"] = f"submit {response.status_code}"
+            else:
+                self._poll(session, response.json()["job_id"], started, sample)
+        except (requests.RequestException, ValueError, KeyError) as error:
+            sample["error"] = type(error).__name__
+
+        sample["latency"] = time.monotonic() - started
+        with self.lock:
+            self.samples.append(sample)
+
+    def _poll(self, session, job_id, started, sample):
+        url = f"{self.base_url}/api/get_results/{job_id}"
+        params = {"wait": self.long_poll} if self.long_poll else None
+        while True:
+            sample["polls"] += 1
+            response = session.get(url, params=params, timeout=self.timeout + self.long_poll)
+            if response.status_code != 200:
+                sample["error"] = f"poll {response.status_code}"
+                return
+            if response.json()["status"] == "done":
+                return
+            if time.monotonic() - started > self.timeout:
+                sample["error"] = "timeout"
+                return
+            if not self.long_poll:
+                time.sleep(self.poll_interval)
+
+
+def run_closed_loop(runner, corpus, concurrency, duration):
+    """
+    Keep `concurrency` clients busy, each sending its next request as soon as the
+    previous one is done.
+    """
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            runner.run_one(*rng.choice(corpus))
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(runner, corpus, rate, duration, concurrency):
+    """
+    Send requests at Poisson arrival times of the given mean rate, however long
+    the server takes to answer.
+    """
+    rng = random.Random(0)
+    start = time.monotonic()
+    due = start
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while due < start + duration:
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(runner.run_one, *rng.choice(corpus), started=due)
+            due += rng.expovariate(rate)
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which the given fraction of the sorted values fall.
+    """
+    if not values:
+        return None
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(samples, elapsed):
+    """
+    Reduce the samples of a run to its report.
+    """
+    def stats(group):
+        latencies = sorted(sample["latency"] for sample in group if sample["error"] is None)
+        errors = sum(1 for sample in group if sample["error"] is not None)
+        return {
+            "requests": len(group),
+            "throughput": len(group) / elapsed if elapsed else 0.0,
+            "error_rate": errors / len(group) if group else 0.0,
+            "mean_polls": sum(sample["polls"] for sample in group) / len(group) if group else 0.0,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+
+    endpoints = sorted({sample["endpoint"] for sample in samples})
+    errors = {}
+    for sample in samples:
+        if sample["error"] is not None:
+            errors[sample["error"]] = errors.get(sample["error"], 0) + 1
+    return {
+        "elapsed": elapsed,
+        "overall": stats(samples),
+        "endpoints": {endpoint: stats([sample for sample in samples
+                                       if sample["endpoint"] == endpoint])
+                      for endpoint in endpoints},
+        "errors": errors,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Return the regressions of a report against a baseline, as readable lines.
+
+    Latency percentiles and the error rate regress when they exceed the baseline
+    by more than `tolerance` (a fraction); throughput when it falls short by it.
+    """
+    regressions = []
+    current, previous = report["overall"], baseline["overall"]
+    for key in ("p50", "p95", "p99"):
+        if current[key] is not None and previous[key] and \
+           current[key] > previous[key] * (1 + tolerance):
+            regressions.append(f"{key} {previous[key] * 1000:.1f} ms -> "
+                               f"{current[key] * 1000:.1f} ms")
+    if current["throughput"] < previous["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {previous['throughput']:.1f}/s -> "
+                           f"{current['throughput']:.1f}/s")
+    if current["error_rate"] > previous["error_rate"] + tolerance / 10:
+        regressions.append(f"error rate {previous['error_rate']:.2%} -> "
+                           f"{current['error_rate']:.2%}")
+    return regressions
+
+
+def print_report(report):
+    """
+    Print a report as a table, one row per endpoint.
+    """
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    print(f"{'endpoint':<24}{'reqs':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'polls':>7}{'errors':>8}")
+    rows = list(report["endpoints"].items()) + [("TOTAL", report["overall"])]
+    for endpoint, stats in rows:
+        print(f"{endpoint:<24}{stats['requests']:>8}{stats['throughput']:>9.1f}"
+              f"{ms(stats['p50']):>9}{ms(stats['p95']):>9}{ms(stats['p99']):>9}"
+              f"{stats['mean_polls']:>7.1f}{stats['error_rate']:>8.2%}")
+    for error, count in report["errors"].items():
+        print(f"error {error}: {count}")
+
+
+def main():
+    """
+    Parse the command line, run the benchmark and report.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--tests-dir", default="tests",
+                        help="directory of <endpoint>/input/*.json request bodies")
+    parser.add_argument("--replay", help="JSONL file of request bodies with an 'endpoint' field")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="clients (closed loop) or maximum in-flight requests (open loop)")
+    parser.add_argument("--rate", type=float,
+                        help="mean arrival rate in requests/s; enables the open loop")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send requests")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--long-poll", type=float, default=0.0,
+                        help="seconds to long-poll with ?wait= instead of polling")
+    parser.add_argument("--timeout", type=float, default=10.0, help="per-request timeout")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.tests_dir, args.replay)
+    if not corpus:
+        parser.error("no requests to replay")
+
+    runner = LoadRunner(args.url.rstrip("/"), args.poll_interval, args.long_poll, args.timeout)
+    started = time.monotonic()
+    if args.rate:
+        run_open_loop(runner, corpus, args.rate, args.duration, args.concurrency)
+    else:
+        run_closed_loop(runner, corpus, args.concurrency, args.duration)
+    report = summarize(runner.samples, time.monotonic() - started)
+    report["config"] = {key: value for key, value in vars(args).items()
+                        if key not in ("output", "baseline")}
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fin:
+            regressions = compare(report, json.load(fin), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Microbenchmark of the analytic tasks on synthetic datasets, apart from the HTTP layer.
+
+Synthetic datasets with the columns the server ingests (Question, LocationDesc,
+Data_Value, StratificationCategory1, Stratification1, YearStart) are generated
+at multiples of the subset's row count. For each dataset the tool measures how
+long building the DataIngestor takes and how long every task type's execute()
+takes, along with the peak memory allocated. A scaling exponent against the previous dataset shows
+where a step grows faster than the row count: 1 is linear and above 1 superlinear.
+
+    python checker/task_bench.py --scales 1,10,100,1000 --output tasks.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import types
+import platform
+import argparse
+import tempfile
+import itertools
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# Import the task modules without running app/__init__.py, which loads the CSV
+# and starts the server's threads
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "app" not in sys.modules:
+    sys.modules["app"] = types.ModuleType("app")
+    sys.modules["app"].__path__ = [os.path.join(ROOT, "app")]
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor, CATEGORY_COLUMNS
+from app.aggregate_index import VALUE_COLUMN
+from app.time_index import YEAR_COLUMN
+from app.task import TASKS_BY_ENDPOINT, BatchTask, create_task
+
+# Rows in nutrition_activity_obesity_usa_subset.csv, roughly
+SUBSET_ROWS = 18000
+
+# Survey years of the dataset
+YEARS = range(2011, 2023)
+
+STATES = [
+    'Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut',
+    'Delaware', 'District of Columbia', 'Florida', 'Georgia', 'Guam', 'Hawaii', 'Idaho',
+    'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine', 'Maryland',
+    'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana',
+    'National', 'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey', 'New Mexico',
+    'New York', 'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon',
+    'Pennsylvania', 'Puerto Rico', 'Rhode Island', 'South Carolina', 'South Dakota',
+    'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virgin Islands', 'Virginia', 'Washington',
+    'West Virginia', 'Wisconsin', 'Wyoming',
+]
+
+SEGMENTS = [
+    ('Age (years)', age) for age in
+    ['18 - 24', '25 - 34', '35 - 44', '45 - 54', '55 - 64', '65 or older']
+] + [
+    ('Education', education) for education in
+    ['Less than high school', 'High school graduate', 'Some college or technical school',
+     'College graduate']
+] + [
+    ('Gender', 'Male'), ('Gender', 'Female'),
+] + [
+    ('Income', income) for income in
+    ['Less than $15,000', '$15,000 - $24,999', '$25,000 - $34,999', '$35,000 - $49,999',
+     '$50,000 - $74,999', '$75,000 or greater', 'Data not reported']
+] + [
+    ('Race/Ethnicity', race) for race in
+    ['Non-Hispanic White', 'Non-Hispanic Black', 'Hispanic', 'Asian', 'Other']
+] + [
+    ('Total', 'Total'),
+]
+CATEGORIES = sorted({category for category, _ in SEGMENTS})
+
+
+def generate_dataset(rows, seed=0):
+    """
+    Generate the ingested columns of a synthetic dataset.
+
+    Values are uniform between 10 and 60 with 5% missing, and 1% of the rows have
+    no stratification, like the rows of the real dataset that lack one.
+
+    Args:
+        rows (int): Number of rows.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        pd.DataFrame: The columns, as kept by DataIngestor.data.
+    """
+    rng = np.random.default_rng(seed)
+    questions = known_questions(DataIngestor.from_frame(_empty_frame()))
+
+    segment_codes = rng.integers(0, len(SEGMENTS), rows)
+    missing = rng.random(rows) < 0.01
+    category_codes = np.array([CATEGORIES.index(category)
+                               for category, _ in SEGMENTS])[segment_codes]
+    category_codes[missing] = -1
+    segment_codes[missing] = -1
+
+    values = rng.uniform(10, 60, rows).round(1)
+    values[rng.random(rows) < 0.05] = np.nan
+
+    return pd.DataFrame({
+        'Question': pd.Categorical.from_codes(rng.integers(0, len(questions), rows),
+                                              questions),
+        'LocationDesc': pd.Categorical.from_codes(rng.integers(0, len(STATES), rows), STATES),
+        'StratificationCategory1': pd.Categorical.from_codes(category_codes, CATEGORIES),
+        'Stratification1': pd.Categorical.from_codes(
+            segment_codes, [segment for _, segment in SEGMENTS]),
+        VALUE_COLUMN: values,
+        YEAR_COLUMN: rng.integers(YEARS.start, YEARS.stop, rows).astype('int16'),
+    })
+
+
+def known_questions(data_ingestor):
+    """
+    Return every question the server answers.
+    """
+    return data_ingestor.questions_best_is_min + data_ingestor.questions_best_is_max
+
+
+def _empty_frame():
+    dtypes = {column: 'category' for column in CATEGORY_COLUMNS}
+    dtypes[VALUE_COLUMN] = 'float64'
+    dtypes[YEAR_COLUMN] = 'int16'
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+
+
+def measure(function, repeat):
+    """
+    Time a function and measure the memory it allocates.
+
+    The timed calls run without tracemalloc, which slows allocations down; one more
+    call is then traced for the peak.
+
+    Returns:
+        dict: The median and minimum seconds per call and the peak bytes allocated.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"median_s": float(np.median(timings)), "min_s": min(timings), "peak_bytes": peak}
+
+
+def benchmark_tasks(data_ingestor, repeat):
+    """
+    Measure execute() of every task type, cycling through the known questions.
+    """
+    questions = known_questions(data_ingestor)
+    results = {}
+    for endpoint, task_class in TASKS_BY_ENDPOINT.items():
+        tasks = itertools.cycle([
+            create_task(endpoint, {"question": question, "state": state}, data_ingestor)
+            for question, state in zip(questions, STATES)])
+        results[task_class.__name__] = measure(lambda tasks=tasks: next(tasks).execute(), repeat)
+
+    queries = [{"endpoint": endpoint, "question": question, "state": STATES[0]}
+               for endpoint in TASKS_BY_ENDPOINT for question in questions]
+    results[BatchTask.__name__] = measure(BatchTask(queries, data_ingestor).execute,
+                                          max(1, repeat // 10))
+    return results
+
+
+def benchmark_scale(scale, base_rows, repeat, with_csv):
+    """
+    Generate the dataset of one scale and measure ingesting it and every task.
+    """
+    rows = scale * base_rows
+    data_frame = generate_dataset(rows, seed=scale)
+    report = {"scale": scale, "rows": rows, "steps": {}}
+
+    ingest_repeat = max(1, min(repeat, 5))
+    report["steps"]["index"] = measure(lambda: DataIngestor.from_frame(data_frame),
+                                       ingest_repeat)
+
+    if with_csv:
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "data.csv")
+            data_frame.to_csv(csv_path, index=False)
+            report["steps"]["read_csv"] = measure(
+                lambda: DataIngestor(csv_path, snapshot_path=''), ingest_repeat)
+
+    report["steps"].update(benchmark_tasks(DataIngestor.from_frame(data_frame), repeat))
+    return report
+
+
+def add_scaling(reports):
+    """
+    Add to every step the exponent of its growth since the previous scale.
+    """
+    for previous, current in zip(reports, reports[1:]):
+        rows_ratio = current["rows"] / previous["rows"]
+        for step, stats in current["steps"].items():
+            before = previous["steps"].get(step)
+            if before and before["median_s"] > 0 and stats["median_s"] > 0:
+                stats["exponent"] = math.log(stats["median_s"] / before["median_s"]) / \
+                    math.log(rows_ratio)
+
+
+def print_reports(reports):
+    """
+    Print the time, peak memory and scaling exponent of every step at every scale.
+    """
+    print(f"{'step':<26}{'scale':>7}{'rows':>12}{'median ms':>12}{'peak KiB':>12}{'exp':>7}")
+    for step in reports[0]["steps"]:
+        for report in reports:
+            stats = report["steps"][step]
+            exponent = f"{stats['exponent']:.2f}" if "exponent" in stats else "-"
+            print(f"{step:<26}{report['scale']:>7}{report['rows']:>12}"
+                  f"{stats['median_s'] * 1000:>12.3f}{stats['peak_bytes'] / 1024:>12.1f}"
+                  f"{exponent:>7}")
+
+
+def main():
+    """
+    Parse the command line, run the benchmark and report.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1,10,100,1000",
+                        help="comma-separated multiples of the base row count")
+    parser.add_argument("--base-rows", type=int, default=SUBSET_ROWS)
+    parser.add_argument("--repeat", type=int, default=100, help="timed calls per task type")
+    parser.add_argument("--csv", action="store_true",
+                        help="also time parsing each dataset from a CSV file")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    scales = sorted(int(scale) for scale in args.scales.split(","))
+    reports = []
+    for scale in scales:
+        reports.append(benchmark_scale(scale, args.base_rows, args.repeat, args.csv))
+        print(f"scale {scale}x done", file=sys.stderr)
+    add_scaling(reports)
+    print_reports(reports)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump({
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "base_rows": args.base_rows,
+                "repeat": args.repeat,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "scales": reports,
+            }, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()